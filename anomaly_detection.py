@@ -0,0 +1,176 @@
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+from operator import itemgetter
+
+import numpy as np
+
+# Parametri di default del rilevamento
+BASELINE_DAYS = 28          # finestra mobile precedente usata come riferimento
+BURST_MIN_MESSAGES = 10     # messaggi minimi in un giorno per considerarlo un picco
+BURST_Z = 4.0               # scostamento minimo (in deviazioni standard) dal riferimento
+SILENCE_DAYS = 7            # giorni consecutivi senza messaggi per segnalare un silenzio
+SILENCE_MIN_RATE = 3.0      # media giornaliera minima nel riferimento per un silenzio anomalo
+SCHEDULE_PERIOD_DAYS = 28   # ampiezza dei periodi confrontati per il profilo orario
+SCHEDULE_MIN_MESSAGES = 30  # messaggi minimi nel periodo e nel riferimento
+SCHEDULE_MIN_DISTANCE = 0.5 # distanza di variazione totale minima tra profili orari
+MIN_CONTACT_MESSAGES = 20   # le chat con meno messaggi vengono ignorate
+CONTACT_BLOCK = 1024        # righe della matrice elaborate per volta, per limitare la memoria
+
+EPOCH = date(1970, 1, 1)
+
+Anomaly = namedtuple("Anomaly", ["kind", "contact", "start", "end", "score", "detail"])
+
+
+def local_hours(utc_hours):
+    """Ore dall'epoch nel fuso locale, con l'offset (ora legale compresa) valido per ciascuna ora UTC.
+
+    L'offset è calcolato una sola volta per ogni ora dell'intervallo coperto, non per ogni riga.
+    """
+    if not len(utc_hours):
+        return utc_hours
+    first = int(utc_hours.min())
+    span = np.arange(first, int(utc_hours.max()) + 1, dtype=np.int64)
+    offsets = np.fromiter((time.localtime(h * 3600).tm_gmtoff for h in span.tolist()), dtype=np.int64, count=len(span))
+    return ((span * 3600 + offsets) // 3600)[utc_hours - first]
+
+
+def _series_label(chat, sender, chat_labels, sender_labels):
+    chat_name = chat_labels.get(str(chat), str(chat).split("@")[0])
+    if sender is None:
+        return chat_name
+    return f"{sender_labels.get(str(sender), str(sender).split('@')[0])} in {chat_name}"
+
+
+class ActivityMatrix:
+    """Conteggi giornalieri (contatti x giorni) e profili orari (contatti x periodi x 24) in array NumPy.
+
+    Ogni serie è una coppia (chat, mittente): una chat privata è una sola serie, un gruppo
+    una serie per partecipante più quella dei messaggi propri.
+    """
+    def __init__(self, rows, chat_labels, sender_labels):
+        n_rows = len(rows)
+        # Fattorizza chat e mittenti con dizionari (sono pochi rispetto alle righe), poi le coppie sugli interi.
+        chats = {key: i for i, key in enumerate(dict.fromkeys(map(itemgetter(0), rows)))}
+        senders = {key: i for i, key in enumerate(dict.fromkeys(map(itemgetter(1), rows)))}
+        chat_idx = np.fromiter(map(chats.__getitem__, map(itemgetter(0), rows)), dtype=np.int64, count=n_rows)
+        sender_idx = np.fromiter(map(senders.__getitem__, map(itemgetter(1), rows)), dtype=np.int64, count=n_rows)
+        pairs, contact_idx = np.unique(chat_idx * len(senders) + sender_idx, return_inverse=True)
+        chat_keys, sender_keys = list(chats), list(senders)
+        index = [(chat_keys[p // len(senders)], sender_keys[p % len(senders)]) for p in pairs.tolist()]
+        hours = local_hours(np.fromiter(map(itemgetter(2), rows), dtype=np.int64, count=n_rows))
+        counts = np.fromiter(map(itemgetter(3), rows), dtype=np.float64, count=n_rows)
+        days = hours // 24
+        self.first_day = int(days.min())
+        day_idx = days - self.first_day
+        n_contacts, n_days = len(index), int(day_idx.max()) + 1
+        self.contacts = [_series_label(chat, sender, chat_labels, sender_labels) for chat, sender in index]
+        self.daily = np.bincount(contact_idx * n_days + day_idx, weights=counts,
+                                 minlength=n_contacts * n_days).astype(np.float32).reshape(n_contacts, n_days)
+        period_idx = day_idx // SCHEDULE_PERIOD_DAYS
+        n_periods = int(period_idx.max()) + 1
+        flat = (contact_idx * n_periods + period_idx) * 24 + hours % 24
+        self.hourly_profile = np.bincount(flat, weights=counts, minlength=n_contacts * n_periods * 24) \
+            .astype(np.float32).reshape(n_contacts, n_periods, 24)
+
+    def day_to_date(self, day_idx):
+        return EPOCH + timedelta(days=self.first_day + int(day_idx))
+
+
+def _runs(flags):
+    """(riga, inizio, fine inclusa) delle sequenze di True consecutive in ogni riga di flags."""
+    padded = np.zeros((flags.shape[0], flags.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = flags
+    edges = np.diff(padded, axis=1)
+    start_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return start_rows, starts, ends - 1
+
+
+def _rolling_baseline(block, window):
+    """Media e deviazione standard della finestra [t - window, t) per ogni giorno t (NaN se incompleta)."""
+    cs = np.zeros((block.shape[0], block.shape[1] + 1))
+    cs2 = np.zeros_like(cs)
+    np.cumsum(block, axis=1, out=cs[:, 1:])
+    np.cumsum(block * block, axis=1, out=cs2[:, 1:])
+    mean = np.full(block.shape, np.nan)
+    std = np.full(block.shape, np.nan)
+    if block.shape[1] > window:
+        total = cs[:, window:-1] - cs[:, :-window - 1]
+        total2 = cs2[:, window:-1] - cs2[:, :-window - 1]
+        mean[:, window:] = total / window
+        std[:, window:] = np.sqrt(np.maximum(total2 / window - mean[:, window:] ** 2, 0.0))
+    return mean, std
+
+
+def _detect_block(matrix, rows):
+    daily = matrix.daily[rows].astype(np.float64)
+    mean, std = _rolling_baseline(daily, BASELINE_DAYS)
+    anomalies = []
+
+    # Picchi: giorni molto sopra la media mobile; i giorni consecutivi formano una sola finestra.
+    with np.errstate(invalid="ignore"):
+        z = (daily - mean) / np.maximum(std, 1.0)
+        burst = (daily >= BURST_MIN_MESSAGES) & (z >= BURST_Z)
+    for r, start, end in zip(*_runs(burst)):
+        peak = float(np.nanmax(z[r, start:end + 1]))
+        anomalies.append(Anomaly("Picco", matrix.contacts[rows[r]], matrix.day_to_date(start), matrix.day_to_date(end), peak,
+                                 f"{int(daily[r, start:end + 1].sum())} messaggi (media {mean[r, start]:.1f}/giorno)"))
+
+    # Silenzi: SILENCE_DAYS giorni senza messaggi dopo un periodo con attività regolare.
+    n_days = daily.shape[1]
+    if n_days > BASELINE_DAYS + SILENCE_DAYS:
+        cs = np.zeros((daily.shape[0], n_days + 1))
+        np.cumsum(daily, axis=1, out=cs[:, 1:])
+        ahead = cs[:, SILENCE_DAYS:] - cs[:, :-SILENCE_DAYS]
+        silent = np.zeros_like(burst)
+        silent[:, :ahead.shape[1]] = ahead == 0
+        # La media di riferimento è quella precedente all'inizio del silenzio, non quella che decade durante.
+        run_rows, starts, ends = _runs(silent)
+        with np.errstate(invalid="ignore"):
+            keep = mean[run_rows, starts] >= SILENCE_MIN_RATE
+        for r, start, end in zip(run_rows[keep], starts[keep], ends[keep]):
+            expected = mean[r, start] * (end - start + SILENCE_DAYS)
+            anomalies.append(Anomaly("Silenzio", matrix.contacts[rows[r]], matrix.day_to_date(start),
+                                     matrix.day_to_date(end + SILENCE_DAYS - 1), float(np.sqrt(expected)),
+                                     f"nessun messaggio, attesi circa {expected:.0f} (media {mean[r, start]:.1f}/giorno)"))
+
+    # Cambi di orario: distribuzione oraria del periodo contro quella dei tre periodi precedenti.
+    profile = matrix.hourly_profile[rows].astype(np.float64)
+    n_periods = profile.shape[1]
+    if n_periods > 1:
+        cp = np.zeros((profile.shape[0], n_periods + 1, 24))
+        np.cumsum(profile, axis=1, out=cp[:, 1:])
+        lookback = np.maximum(np.arange(1, n_periods) - 3, 0)
+        baseline = cp[:, 1:n_periods] - cp[:, lookback]
+        current = profile[:, 1:]
+        n_cur, n_base = current.sum(axis=2), baseline.sum(axis=2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            distance = 0.5 * np.abs(current / n_cur[..., None] - baseline / n_base[..., None]).sum(axis=2)
+        changed = (n_cur >= SCHEDULE_MIN_MESSAGES) & (n_base >= SCHEDULE_MIN_MESSAGES) & (distance >= SCHEDULE_MIN_DISTANCE)
+        for r, p in zip(*np.nonzero(changed)):
+            start = (p + 1) * SCHEDULE_PERIOD_DAYS
+            peak_now, peak_before = int(current[r, p].argmax()), int(baseline[r, p].argmax())
+            anomalies.append(Anomaly("Cambio orario", matrix.contacts[rows[r]], matrix.day_to_date(start),
+                                     matrix.day_to_date(min(start + SCHEDULE_PERIOD_DAYS, n_days) - 1),
+                                     float(distance[r, p] * np.sqrt(min(n_cur[r, p], n_base[r, p]))),
+                                     f"ora di punta {peak_before:02d}:00 -> {peak_now:02d}:00, distanza profili {distance[r, p]:.2f}"))
+    return anomalies
+
+
+def detect_anomalies(rows, chat_labels, sender_labels=(), limit=200):
+    """Rileva picchi, silenzi e cambi di orario per tutti i contatti e li restituisce ordinati per punteggio.
+
+    rows: righe (chiave chat, chiave mittente, ora UTC dall'epoch, conteggio) di get_contact_hourly_counts().
+    chat_labels, sender_labels: coppie (chiave, nome visualizzato) di get_chat_labels() e get_sender_labels().
+    Le ore sono convertite nel fuso locale riga per riga, così l'ora legale non sposta i profili orari.
+    """
+    if not rows:
+        return []
+    matrix = ActivityMatrix(rows, {str(k): v for k, v in chat_labels if v}, {str(k): v for k, v in sender_labels if v})
+    active = np.flatnonzero(matrix.daily.sum(axis=1) >= MIN_CONTACT_MESSAGES)
+    anomalies = []
+    for i in range(0, len(active), CONTACT_BLOCK):
+        anomalies.extend(_detect_block(matrix, active[i:i + CONTACT_BLOCK]))
+    anomalies.sort(key=lambda a: a.score, reverse=True)
+    return anomalies[:limit]
@@ -0,0 +1,261 @@
+"""Server HTTP/JSON locale che espone le query di DatabaseManager a più analisti.
+
+Avvio:
+    python api_server.py msgstore.db [--host 127.0.0.1] [--port 8765] [--timeout 30] [--token SEGRETO]
+
+Tutti gli endpoint sono GET e restituiscono JSON. Le liste sono paginate con ?offset=&page_size=,
+?timeout= riduce il tempo massimo della singola query e l'ambito di analisi si imposta per
+singola richiesta con ?start=&end=&chat=&contact= (date AAAA-MM-GG oppure AAAA-MM-GGTHH:MM).
+"""
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+
+from database_manager import DatabaseManager, AnalysisScope, NearDuplicateIndexMissing
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_REQUEST_LINE = 8192
+DEFAULT_MAX_RESULT_BYTES = 256 * 1024 * 1024
+
+# Endpoint -> (metodo di DatabaseManager, parametri della query string ammessi, parametri obbligatori)
+ROUTES = {
+    "/api/summary": ("get_summary_stats", (), ()),
+    "/api/chats/active": ("get_active_chats", ("limit",), ()),
+    "/api/chats/recent": ("get_recent_chats", ("limit",), ()),
+    "/api/chats/ephemeral": ("get_ephemeral_chats", (), ()),
+    "/api/messages/deleted": ("get_deleted_messages", ("number_filter",), ()),
+    "/api/messages/search": ("search_messages_by_word", ("word",), ("word",)),
+    "/api/messages/latest": ("search_latest_messages", ("search_key",), ("search_key",)),
+    "/api/messages/onetime": ("search_onetime_messages", ("number",), ("number",)),
+    "/api/messages/text": ("get_all_text_messages", (), ()),
+    "/api/messages/timestamps": ("get_message_timestamps", (), ()),
+    "/api/messages/similar": ("find_similar_messages", ("text", "limit"), ("text",)),
+    "/api/messages/families": ("get_message_families", ("min_size", "limit"), ()),
+    "/api/locations": ("search_locations_by_number", ("number",), ("number",)),
+    "/api/media": ("get_media_analysis_data", (), ()),
+    "/api/analysis/anomalies": ("detect_communication_anomalies", ("limit",), ()),
+    "/api/analysis/sentiment": ("get_text_for_sentiment", (), ()),
+    "/api/analysis/clustering": ("get_messages_for_clustering", ("limit",), ()),
+}
+INTEGER_PARAMS = {"limit", "min_size"}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_scope(query):
+    """Costruisce l'AnalysisScope della richiesta; una data di fine senza ora include l'intera giornata."""
+    def parse_date(value, end_of_range=False):
+        if not value: return None
+        try:
+            if "T" in value or " " in value:
+                return datetime.fromisoformat(value)
+            day = datetime.strptime(value, "%Y-%m-%d")
+            return day + timedelta(days=1) if end_of_range else day
+        except ValueError:
+            raise ApiError(400, f"Data non valida: {value}")
+    return AnalysisScope(start=parse_date(query.get("start")), end=parse_date(query.get("end"), end_of_range=True),
+                         chat=query.get("chat"), contact=query.get("contact"))
+
+
+def paginate(rows, query):
+    try:
+        offset = max(0, int(query.get("offset", 0)))
+        page_size = min(MAX_PAGE_SIZE, max(1, int(query.get("page_size", DEFAULT_PAGE_SIZE))))
+    except ValueError:
+        raise ApiError(400, "offset e page_size devono essere numeri interi.")
+    return {"total": len(rows), "offset": offset, "page_size": page_size,
+            "items": [list(row) if isinstance(row, tuple) else row for row in rows[offset:offset + page_size]]}
+
+
+class ForensicApiServer:
+    """Server asyncio che condivide un solo DatabaseManager (pool di connessioni e cache) tra i client."""
+    def __init__(self, db_manager, host="127.0.0.1", port=8765, timeout=30.0, workers=4, token=None,
+                 max_result_bytes=DEFAULT_MAX_RESULT_BYTES):
+        self.db = db_manager
+        self.max_result_bytes = max_result_bytes
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.token = token
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query")
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self._handle_client, self.host, self.port, limit=MAX_REQUEST_LINE)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            status, body = await self._handle_request(reader)
+        except ApiError as e:
+            status, body = e.status, {"error": str(e)}
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        except Exception as e:
+            status, body = 500, {"error": f"Errore interno: {e}"}
+        if status is not None:
+            await self._send_json(writer, status, body)
+        writer.close()
+
+    async def _handle_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line: break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise ApiError(400, "Richiesta HTTP non valida.")
+        method, target, _ = parts
+        if method != "GET":
+            raise ApiError(405, "Sono supportate solo richieste GET.")
+        if self.token and not hmac.compare_digest(headers.get("authorization", "").encode("utf-8"),
+                                                  f"Bearer {self.token}".encode("utf-8")):
+            raise ApiError(401, "Token di accesso mancante o non valido.")
+
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path in ("/api", "/api/"):
+            return 200, {"endpoints": sorted(ROUTES) + ["/api/cache/stats"], "schema": self.db.schema_version}
+        if url.path == "/api/cache/stats":
+            return 200, self.db.cache.stats()
+        if url.path not in ROUTES:
+            raise ApiError(404, f"Endpoint sconosciuto: {url.path}")
+
+        method_name, allowed, required = ROUTES[url.path]
+        missing = [p for p in required if not query.get(p)]
+        if missing:
+            raise ApiError(400, f"Parametri obbligatori mancanti: {', '.join(missing)}")
+        kwargs = {}
+        for name in allowed:
+            if name in query:
+                try:
+                    kwargs[name] = int(query[name]) if name in INTEGER_PARAMS else query[name]
+                except ValueError:
+                    raise ApiError(400, f"Il parametro {name} deve essere un numero intero.")
+        scope = parse_scope(query)
+        timeout = self.timeout
+        if query.get("timeout"):
+            try:
+                timeout = min(self.timeout, max(0.1, float(query["timeout"])))
+            except ValueError:
+                raise ApiError(400, "Il parametro timeout deve essere un numero.")
+
+        result = await self._run_cancellable(reader, getattr(self.db, method_name), kwargs, scope, timeout)
+        if result is None:
+            return None, None
+        # Le query interrotte dalla scadenza o fuori budget restituiscono un risultato parziale.
+        meta = {"endpoint": url.path, "scope": scope.describe(), "truncated": getattr(result, "truncated", False),
+                "unsupported": getattr(result, "unsupported", None)}
+        if isinstance(result, dict):
+            return 200, {**meta, "result": result}
+        return 200, {**meta, **paginate(result, query)}
+
+    async def _run_cancellable(self, reader, method, kwargs, scope, timeout):
+        """Esegue la query in un thread del pool; la annulla se scade il tempo o il client si disconnette."""
+        cancel_event = threading.Event()
+
+        def call():
+            with self.db.query_limits(timeout=timeout, cancel_event=cancel_event, max_bytes=self.max_result_bytes), \
+                    self.db.using_scope(scope):
+                return method(**kwargs)
+
+        query_task = asyncio.get_running_loop().run_in_executor(self.executor, call)
+        disconnect_task = asyncio.ensure_future(reader.read(1))
+        try:
+            done, _ = await asyncio.wait({query_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+            if query_task not in done and disconnect_task.result() == b"":
+                # Il client ha chiuso la connessione: interrompe la query e non risponde.
+                cancel_event.set()
+                return None
+            return await query_task
+        except NearDuplicateIndexMissing as e:
+            raise ApiError(503, f"{e} Avviare il server con --near-duplicates.")
+        except sqlite3.Error as e:
+            raise ApiError(500, f"Errore SQLite: {e}")
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+        finally:
+            disconnect_task.cancel()
+
+    async def _send_json(self, writer, status, body):
+        reasons = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                   405: "Method Not Allowed", 500: "Internal Server Error", 503: "Service Unavailable"}
+        payload = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n")
+        try:
+            writer.write(head.encode("latin-1") + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def _is_local_address(host):
+    """Accetta solo loopback e indirizzi di rete privata (LAN) specifici.
+
+    0.0.0.0 e :: risultano "privati" per ipaddress ma ascoltano su tutte le interfacce, anche pubbliche.
+    """
+    if host == "localhost": return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    if address.is_unspecified:
+        return False
+    return address.is_loopback or address.is_private
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server HTTP/JSON locale per l'analisi di msgstore.db")
+    parser.add_argument("db_path", help="Percorso del database msgstore.db")
+    parser.add_argument("--host", default="127.0.0.1", help="Indirizzo di ascolto (loopback o LAN)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30.0, help="Tempo massimo per query in secondi")
+    parser.add_argument("--workers", type=int, default=4, help="Query eseguibili in parallelo")
+    parser.add_argument("--token", help="Se indicato, richiede l'header 'Authorization: Bearer <token>'")
+    parser.add_argument("--max-result-mb", type=int, default=DEFAULT_MAX_RESULT_BYTES // 1048576,
+                        help="Budget di memoria per il risultato di una singola query (MB)")
+    parser.add_argument("--disk-cache", action="store_true", help="Abilita la cache persistente su disco")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="Carica o costruisce all'avvio l'indice dei messaggi simili (le richieste non lo costruiscono)")
+    args = parser.parse_args()
+    if not _is_local_address(args.host):
+        parser.error("Il server può ascoltare solo su loopback o su un indirizzo di rete privata.")
+
+    db_manager = DatabaseManager(args.db_path, disk_cache=args.disk_cache, pool_size=args.workers, interactive=False)
+    server = ForensicApiServer(db_manager, args.host, args.port, args.timeout, args.workers, args.token,
+                               max_result_bytes=args.max_result_mb * 1048576)
+    print(f"Database: {args.db_path} (schema {db_manager.schema_version}, SHA-256 {db_manager.snapshot.snapshot_hash})")
+    if args.near_duplicates:
+        index = db_manager.load_near_duplicate_index(progress=lambda done: print(f"\rIndice messaggi simili: {done} messaggi", end=""))
+        print(f"\rIndice messaggi simili pronto: {len(index)} messaggi")
+    print(f"In ascolto su http://{args.host}:{args.port}/api")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=False, cancel_futures=True)
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,180 +2,563 @@ import sqlite3
 import os
 from tkinter import messagebox
 import re
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from evidence_snapshot import EvidenceSnapshot
+from query_catalog import QueryCatalog
+from result_cache import ResultCache, cached_query, DEFAULT_MEMORY_BUDGET, DISK_CACHE_ROOT
+
+# Ogni quante istruzioni della VM di SQLite viene consultato il progress handler.
+PROGRESS_HANDLER_STEPS = 10000
+FETCH_BATCH_SIZE = 1000
+DEFAULT_POOL_SIZE = 4
+
+# Limiti e ambito validi per il contesto corrente (thread o task asyncio), impostati da
+# DatabaseManager.query_limits() e DatabaseManager.using_scope().
+_query_limits = ContextVar("query_limits", default=None)
+_scope_override = ContextVar("scope_override", default=None)
+
+class QueryLimits:
+    """Scadenza, budget di righe/byte e segnale di annullamento di una query.
+
+    Scadenza e annullamento sono controllati dal progress handler di SQLite; i budget
+    durante la lettura a blocchi dei risultati.
+    """
+    def __init__(self, timeout=None, cancel_event=None, max_rows=None, max_bytes=None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.cancel_event = cancel_event or threading.Event()
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+    def should_abort(self):
+        return self.cancel_event.is_set() or (self.deadline is not None and time.monotonic() > self.deadline)
+
+class QueryResult(list):
+    """Righe restituite da una query.
+
+    truncated=True indica un risultato parziale (scadenza, annullamento o budget superato);
+    complete=False se la query è fallita o parziale, e in tal caso non viene messa in cache.
+    unsupported contiene il motivo se l'analisi non è disponibile per il database: un risultato
+    vuoto non va confuso con "nessun elemento trovato".
+    """
+    def __init__(self, rows=(), complete=True, truncated=False, unsupported=None):
+        super().__init__(rows)
+        self.truncated = truncated
+        self.complete = complete and not truncated
+        self.unsupported = unsupported
+
+class QueryStats(dict):
+    """Dizionario di statistiche con gli stessi indicatori complete/truncated di QueryResult."""
+    def __init__(self, values, complete=True, truncated=False):
+        super().__init__(values)
+        self.truncated = truncated
+        self.complete = complete and not truncated
+
+class NearDuplicateIndexMissing(Exception):
+    """L'indice dei messaggi simili non esiste e non può essere costruito in questo contesto."""
+
+class IndexBuildInterrupted(Exception):
+    """Costruzione di un indice interrotta da scadenza o annullamento."""
+
+def _row_size(row):
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row)
+
+class AnalysisScope:
+    """Ambito globale delle analisi: intervallo temporale [start, end), chat e contatto."""
+    def __init__(self, start=None, end=None, chat=None, contact=None):
+        self.start = start
+        self.end = end
+        self.chat = chat or None
+        self.contact = contact or None
+
+    def is_empty(self):
+        return not any((self.start, self.end, self.chat, self.contact))
+
+    def key(self):
+        return (self.start and self.start.isoformat(), self.end and self.end.isoformat(), self.chat, self.contact)
+
+    def to_params(self, ts_unit):
+        """Traduce l'ambito nei parametri delle clausole scope_* del catalogo."""
+        return {
+            "scope_start": int(self.start.timestamp() * ts_unit) if self.start else None,
+            "scope_end": int(self.end.timestamp() * ts_unit) if self.end else None,
+            "scope_chat": f"%{self.chat}%" if self.chat else None,
+            "scope_contact": f"%{self.contact}%" if self.contact else None,
+        }
+
+    def describe(self):
+        if self.is_empty(): return "Intero database"
+        parts = []
+        if self.start: parts.append(f"dal {self.start.strftime('%Y-%m-%d %H:%M')}")
+        if self.end: parts.append(f"al {self.end.strftime('%Y-%m-%d %H:%M')} (escluso)")
+        if self.chat: parts.append(f"chat: {self.chat}")
+        if self.contact: parts.append(f"contatto: {self.contact}")
+        return ", ".join(parts)
 
 class DatabaseManager:
     """Gestisce tutte le interazioni con il database SQLite di WhatsApp."""
-    def __init__(self, db_path):
+    def __init__(self, db_path, cache_bytes=DEFAULT_MEMORY_BUDGET, disk_cache=False, pool_size=DEFAULT_POOL_SIZE, interactive=True):
         if not os.path.exists(db_path):
             raise FileNotFoundError(f"Il file del database non è stato trovato: {db_path}")
-        self.db_path = db_path
+        self.source_path = db_path
+        # interactive=False (modalità server): gli errori vengono sollevati invece di aprire un messagebox.
+        self.interactive = interactive
+        # Il database viene aperto da una copia di lavoro verificata se sono presenti file WAL.
+        self.snapshot = EvidenceSnapshot(db_path).prepare()
+        self.db_path = self.snapshot.path
+        self.fingerprint = self.snapshot.fingerprint
+        self.catalog = self._load_catalog()
+        self.schema_version = self.catalog.schema_version
+        self._scope = AnalysisScope()
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # Connessioni con una query in corso e relativi limiti, per l'annullamento da un altro thread.
+        self._active = {}
+        self._active_lock = threading.Lock()
+        # Archivio colonnare in memoria (message_store), caricato su richiesta con load_into_memory().
+        self.memory_store = None
+        # Indice MinHash/LSH dei messaggi quasi duplicati (near_duplicates), caricato su richiesta.
+        self.near_duplicate_index = None
+        self._near_duplicate_lock = threading.Lock()
+        # Funzione opzionale callback(done, truncated=False): chiamata dal progress handler durante
+        # la query (done=False) e una volta al termine (done=True).
+        self.progress_callback = None
+        self.cache = ResultCache(self.fingerprint, max_bytes=cache_bytes, disk_dir=DISK_CACHE_ROOT if disk_cache else None)
+
+    def _load_catalog(self):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro&immutable=1", uri=True)
+        try:
+            catalog = QueryCatalog(conn, cache_key=self.fingerprint)
+            # Unità dei timestamp rilevata una sola volta, fuori da limiti e progress handler:
+            # una sonda interrotta non deve lasciare un'unità sbagliata per tutta la sessione.
+            built = catalog.build("max_timestamp")
+            max_ts = conn.execute(*built).fetchone()[0] if built else None
+            self._ts_unit = 1000 if max_ts and max_ts > 1e12 else 1
+            return catalog
+        finally:
+            conn.close()
+
+    def _report_error(self, title, message, error):
+        if not self.interactive:
+            raise error
+        messagebox.showerror(title, f"{message}\n{error}")
 
     def _connect_db(self):
         try:
-            return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            # immutable=1: la prova non cambia durante la sessione, SQLite salta lock e controlli di modifica.
+            # check_same_thread=False: le connessioni del pool vengono riusate da thread diversi, una alla volta.
+            return sqlite3.connect(f"file:{self.db_path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
         except sqlite3.Error as e:
-            messagebox.showerror("Errore Database", f"Impossibile connettersi al database:\n{e}")
+            self._report_error("Errore Database", "Impossibile connettersi al database:", e)
             return None
 
+    def _acquire_connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect_db()
+
+    def _release_connection(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """Chiude le connessioni inattive del pool."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @contextmanager
+    def _guarded_connection(self):
+        """Connessione del pool con progress handler e limiti del contesto corrente, annullabile con cancel().
+
+        Restituisce (connessione, limiti); la connessione è None se non è stato possibile aprirla.
+        """
+        conn = self._acquire_connection()
+        limits = _query_limits.get() or QueryLimits()
+        if conn is None:
+            yield None, limits
+            return
+        callback = self.progress_callback
+        def progress():
+            if callback is not None:
+                try:
+                    callback(False)
+                except Exception:
+                    pass
+            return 1 if limits.should_abort() else 0
+        conn.set_progress_handler(progress, PROGRESS_HANDLER_STEPS)
+        with self._active_lock:
+            self._active[conn] = limits
+        try:
+            yield conn, limits
+        finally:
+            with self._active_lock:
+                self._active.pop(conn, None)
+            conn.set_progress_handler(None, 0)
+            self._release_connection(conn)
+
     def _fetch_data(self, query, params=None):
-        conn = self._connect_db()
-        if conn is None: return []
+        with self._guarded_connection() as (conn, limits):
+            if conn is None: return QueryResult(complete=False)
+            return self._fetch_rows(conn, limits, query, params)
+
+    def _fetch_rows(self, conn, limits, query, params):
+        callback = self.progress_callback
+        rows, size, truncated = [], 0, False
         try:
             cursor = conn.cursor()
             cursor.execute(query, params or [])
-            return cursor.fetchall()
+            while True:
+                batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+                if not batch: break
+                if limits.max_bytes is not None:
+                    for i, row in enumerate(batch):
+                        size += _row_size(row)
+                        if size > limits.max_bytes:
+                            batch, truncated = batch[:i], True
+                            break
+                rows.extend(batch)
+                if limits.max_rows is not None and len(rows) >= limits.max_rows:
+                    truncated = truncated or len(rows) > limits.max_rows or cursor.fetchone() is not None
+                    del rows[limits.max_rows:]
+                if truncated: break
+            return QueryResult(rows, truncated=truncated)
+        except sqlite3.OperationalError as e:
+            if limits.should_abort():
+                # Scadenza o annullamento: restituisce le righe già lette come risultato parziale.
+                truncated = True
+                return QueryResult(rows, truncated=True)
+            self._report_error("Errore Query SQL", "Errore durante l'esecuzione della query:", e)
+            return QueryResult(complete=False)
         except sqlite3.Error as e:
-            messagebox.showerror("Errore Query SQL", f"Errore durante l'esecuzione della query:\n{e}")
-            return []
+            self._report_error("Errore Query SQL", "Errore durante l'esecuzione della query:", e)
+            return QueryResult(complete=False)
         finally:
-            if conn: conn.close()
+            if callback is not None:
+                callback(True, truncated)
+
+    def cancel(self):
+        """Annulla tutte le query in corso: imposta il segnale di annullamento e interrompe le connessioni."""
+        with self._active_lock:
+            active = list(self._active.items())
+        for conn, limits in active:
+            limits.cancel_event.set()
+            conn.interrupt()
+        return len(active)
+
+    @contextmanager
+    def query_limits(self, timeout=None, cancel_event=None, max_rows=None, max_bytes=None):
+        """Applica scadenza, budget e annullamento alle query eseguite nel contesto corrente."""
+        limits = QueryLimits(timeout, cancel_event, max_rows, max_bytes)
+        token = _query_limits.set(limits)
+        try:
+            yield limits
+        finally:
+            _query_limits.reset(token)
+
+    @contextmanager
+    def using_scope(self, scope):
+        """Sostituisce l'ambito di analisi solo nel contesto corrente (es. una richiesta API)."""
+        token = _scope_override.set(scope)
+        try:
+            yield
+        finally:
+            _scope_override.reset(token)
+
+    @property
+    def scope(self):
+        return _scope_override.get() or self._scope
+
+    def _run_query(self, name, **params):
+        """Esegue la variante del catalogo adatta allo schema; se non supportata restituisce una lista vuota."""
+        if not self.scope.is_empty():
+            params.update(self.scope.to_params(self.timestamp_unit))
+        built = self.catalog.build(name, **params)
+        if built is None: return QueryResult(unsupported=self.catalog.unavailable_reason(name))
+        return self._fetch_data(*built)
+
+    def _apply_query_limits(self, result):
+        """Applica max_rows/max_bytes del contesto corrente a un risultato già calcolato (es. dalla cache)."""
+        limits = _query_limits.get()
+        if limits is None or not isinstance(result, QueryResult) or (limits.max_rows is None and limits.max_bytes is None):
+            return result
+        rows = result
+        if limits.max_bytes is not None:
+            size = 0
+            for i, row in enumerate(rows):
+                size += _row_size(row)
+                if size > limits.max_bytes:
+                    rows = rows[:i]
+                    break
+        if limits.max_rows is not None:
+            rows = rows[:limits.max_rows]
+        if len(rows) == len(result):
+            return result
+        return QueryResult(rows, truncated=True)
 
+    def _cache_key_parts(self):
+        """Parti della chiave di cache che dipendono dallo stato del manager."""
+        # Anche la modalità (SQL o archivio in memoria): l'ordine dei pari merito può differire.
+        return (self.fingerprint, self.schema_version, self.scope.key(), self.memory_store is not None)
+
+    def set_scope(self, scope=None):
+        """Imposta l'ambito applicato da tutte le query successive (None = intero database)."""
+        self._scope = scope or AnalysisScope()
+
+    def load_into_memory(self, cap_bytes=None):
+        """Carica i messaggi nell'archivio colonnare in memoria.
+
+        Restituisce (caricato, descrizione). Se lo schema non è supportato o la stima
+        dell'occupazione supera cap_bytes, le analisi continuano a usare SQL.
+        """
+        from message_store import MessageStore, DEFAULT_MEMORY_CAP, LOAD_BATCH_SIZE
+        cap_bytes = DEFAULT_MEMORY_CAP if cap_bytes is None else cap_bytes
+        self.memory_store = None
+        names = ("memory_store_size", "memory_store_rows", "memory_store_chats", "memory_store_jids")
+        if not all(self.catalog.is_available(n) for n in names):
+            return False, f"Archivio in memoria non disponibile per lo schema {self.schema_version}."
+        size_rows = self._fetch_data(*self.catalog.build("memory_store_size"))
+        if not size_rows.complete:
+            return False, "Impossibile stimare la dimensione dell'archivio in memoria."
+        n_rows, text_bytes = size_rows[0]
+        estimate = MessageStore.estimate_bytes(n_rows, text_bytes)
+        if estimate > cap_bytes:
+            return False, f"Archivio in memoria non caricato: {estimate / 1048576:.0f} MB stimati oltre il limite di {cap_bytes / 1048576:.0f} MB."
+        conn = self._acquire_connection()
+        if conn is None:
+            return False, "Impossibile aprire il database per l'archivio in memoria."
+        try:
+            cursor = conn.execute(*self.catalog.build("memory_store_rows"))
+            batches = iter(lambda: cursor.fetchmany(LOAD_BATCH_SIZE), [])
+            chats = conn.execute(*self.catalog.build("memory_store_chats")).fetchall()
+            jids = conn.execute(*self.catalog.build("memory_store_jids")).fetchall()
+            self.memory_store = MessageStore.build(n_rows, text_bytes, batches, chats, jids)
+        finally:
+            self._release_connection(conn)
+        return True, self.memory_store.describe()
+
+    def unload_memory(self):
+        self.memory_store = None
+
+    def _memory_mask(self):
+        return self.memory_store.scope_mask(self.scope, self.timestamp_unit)
+
+    def load_near_duplicate_index(self, rebuild=False, workers=None, progress=None, build=True):
+        """Carica l'indice dei messaggi quasi duplicati dal file .npz dell'impronta, o lo costruisce.
+
+        La costruzione legge i testi a blocchi e calcola le firme MinHash su più processi;
+        progress(messaggi_indicizzati) viene chiamata dopo ogni blocco. Avviene una sola volta
+        anche con più richieste concorrenti e rispetta scadenza e annullamento del contesto.
+        Con build=False un indice assente solleva NearDuplicateIndexMissing.
+        """
+        from near_duplicates import NearDuplicateIndex, BATCH_SIZE, MIN_TEXT_LENGTH
+        if self.near_duplicate_index is not None and not rebuild:
+            return self.near_duplicate_index
+        with self._near_duplicate_lock:
+            if self.near_duplicate_index is not None and not rebuild:
+                return self.near_duplicate_index
+            path = NearDuplicateIndex.sidecar_path(self.fingerprint)
+            index = None if rebuild else NearDuplicateIndex.load(path)
+            if index is None:
+                if not build:
+                    raise NearDuplicateIndexMissing("Indice dei messaggi simili non ancora costruito per questo database.")
+                built = self.catalog.build("near_duplicate_texts", min_length=MIN_TEXT_LENGTH)
+                if built is None:
+                    raise NearDuplicateIndexMissing(f"Indice dei messaggi simili non disponibile per lo schema {self.schema_version}.")
+                index = self._build_near_duplicate_index(built, BATCH_SIZE, workers, progress)
+                try:
+                    index.save(path)
+                except OSError:
+                    pass
+            self.near_duplicate_index = index
+            return index
+
+    def _build_near_duplicate_index(self, built, batch_size, workers, progress):
+        from near_duplicates import NearDuplicateIndex
+        with self._guarded_connection() as (conn, limits):
+            if conn is None:
+                raise sqlite3.OperationalError("Impossibile connettersi al database.")
+            callback = self.progress_callback
+            def batches():
+                cursor = conn.execute(*built)
+                for batch in iter(lambda: cursor.fetchmany(batch_size), []):
+                    # Controllo anche tra un blocco e l'altro: le firme sono calcolate fuori da SQLite.
+                    if callback is not None:
+                        callback(False)
+                    if limits.should_abort():
+                        raise sqlite3.OperationalError("interrupted")
+                    yield batch
+            try:
+                return NearDuplicateIndex.build(batches(), workers, progress)
+            except sqlite3.OperationalError:
+                if limits.should_abort():
+                    raise IndexBuildInterrupted("Costruzione dell'indice dei messaggi simili interrotta.")
+                raise
+            finally:
+                if callback is not None:
+                    callback(True)
+
+    def _near_duplicate_mask(self, index):
+        """Righe dell'indice nell'ambito corrente (None = intero database)."""
+        import numpy as np
+        if self.scope.is_empty():
+            return None
+        scoped = self._run_query("near_duplicate_scope_ids")
+        return np.isin(index.ids, np.fromiter((row[0] for row in scoped), dtype=np.int64, count=len(scoped)))
+
+    def _near_duplicate_details(self, ids):
+        """Dettagli (testo, data, direzione, mittente, chat) per id di messaggio, nell'ambito corrente."""
+        rows = self._run_query("near_duplicate_details", ids=json.dumps([int(i) for i in ids]))
+        return {row[0]: row[1:] for row in rows}
+
+    def find_similar_messages(self, text, threshold=None, limit=100):
+        """Messaggi quasi identici a text (anche con piccole modifiche), dal più simile.
+
+        Righe (similarità, testo, timestamp, from_me, mittente, numero chat, gruppo).
+        """
+        from near_duplicates import DEFAULT_THRESHOLD
+        index = self.load_near_duplicate_index(build=self.interactive)
+        rows, similarity = index.query_text(text, threshold or DEFAULT_THRESHOLD, self._near_duplicate_mask(index))
+        ids = index.ids[rows[:limit]].tolist()
+        details = self._near_duplicate_details(ids)
+        return QueryResult((round(float(sim), 3),) + details[i] for i, sim in zip(ids, similarity.tolist()) if i in details)
+
+    @cached_query
+    def get_message_families(self, threshold=None, min_size=3, limit=50):
+        """Famiglie di messaggi quasi identici più diffuse (catene inoltrate), dalla più numerosa.
+
+        Righe (messaggi, chat distinte, primo timestamp, ultimo timestamp, testo del primo messaggio, chat principali).
+        """
+        import numpy as np
+        from near_duplicates import FAMILY_THRESHOLD
+        index = self.load_near_duplicate_index(build=self.interactive)
+        families = index.families(threshold or FAMILY_THRESHOLD, self._near_duplicate_mask(index), min_size, limit)
+        labels = {str(k): v for k, v in self._run_query("chat_labels") if v}
+        first_rows = [rows[np.argmin(index.timestamps[rows])] for rows in families]
+        details = self._near_duplicate_details(index.ids[first_rows].tolist()) if families else {}
+        results = []
+        for rows, first in zip(families, first_rows):
+            chats, counts = np.unique(index.chat_idx[rows], return_counts=True)
+            top_chats = [labels.get(str(index.chat_keys[c]), str(index.chat_keys[c])) for c in chats[np.argsort(-counts)][:3]]
+            text = details.get(int(index.ids[first]), (None,))[0]
+            results.append((len(rows), len(chats), int(index.timestamps[rows].min()), int(index.timestamps[rows].max()),
+                            text, ", ".join(top_chats)))
+        return QueryResult(results)
+
+    @property
+    def timestamp_unit(self):
+        """Moltiplicatore dei secondi nei timestamp del database (1000 se in millisecondi)."""
+        return self._ts_unit
+
+    @cached_query
     def get_messages_for_clustering(self, limit=1000):
         """Recupera messaggi testuali significativi per l'analisi di clustering."""
-        query = """
-            SELECT
-                m.text_data
-            FROM message m
-            WHERE m.text_data IS NOT NULL
-              AND LENGTH(TRIM(m.text_data)) > 25
-              AND m.message_type = 0
-            LIMIT ?;
-        """
-        return self._fetch_data(query, (limit,))
+        return self._run_query("messages_for_clustering", limit=limit)
 
+    @cached_query
     def get_deleted_messages(self, number_filter=None):
-        base_query = """
-            SELECT
-                CASE WHEN chat.subject IS NOT NULL THEN sender_jid.user ELSE chat_jid.user END,
-                chat.subject, message.timestamp, message_revoked.revoke_timestamp, message.from_me
-            FROM message_revoked
-            JOIN message ON message._id = message_revoked.message_row_id
-            JOIN chat ON message.chat_row_id = chat._id
-            JOIN jid AS chat_jid ON chat.jid_row_id = chat_jid._id
-            LEFT JOIN jid AS sender_jid ON message.sender_jid_row_id = sender_jid._id
-        """
-        params = []
-        if number_filter:
-            base_query += " WHERE (chat_jid.user LIKE ? OR sender_jid.user LIKE ?)"
-            params.extend([f"%{number_filter}%", f"%{number_filter}%"])
-        
-        # Corretto 'message_timestamp' con 'message.timestamp' che è il nome di colonna valido.
-        base_query += " ORDER BY message.timestamp DESC;"
-        return self._fetch_data(base_query, tuple(params))
+        return self._run_query("deleted_messages", number=f"%{number_filter}%" if number_filter else None)
 
+    @cached_query
     def get_summary_stats(self):
-        query_messages = "SELECT COUNT(*) FROM message;"
-        query_chats = "SELECT COUNT(*) FROM chat;"
-        query_date_range = "SELECT MIN(timestamp), MAX(timestamp) FROM message WHERE timestamp > 0;"
-        total_messages = self._fetch_data(query_messages)[0][0] or 0
-        total_chats = self._fetch_data(query_chats)[0][0] or 0
-        date_range = self._fetch_data(query_date_range)
-        start_ts, end_ts = (None, None)
-        if date_range and date_range[0]:
-            start_ts, end_ts = date_range[0]
-        return {"total_messages": total_messages, "total_chats": total_chats, "start_date": start_ts, "end_date": end_ts}
+        rows = self._run_query("summary_stats")
+        total_messages, total_chats, start_ts, end_ts = rows[0] if rows else (0, 0, None, None)
+        return QueryStats({"total_messages": total_messages or 0, "total_chats": total_chats or 0, "start_date": start_ts, "end_date": end_ts},
+                          complete=rows.complete, truncated=rows.truncated)
 
+    @cached_query
     def get_active_chats(self, limit=10):
-        query = """
-            SELECT
-                CASE WHEN chat.subject IS NOT NULL THEN chat.subject ELSE jid.user END,
-                COUNT(message._id)
-            FROM chat
-            JOIN jid ON chat.jid_row_id = jid._id
-            JOIN message ON chat._id = message.chat_row_id
-            GROUP BY 1 ORDER BY 2 DESC LIMIT ?;
-        """
-        return self._fetch_data(query, (limit,))
+        if self.memory_store is not None:
+            return QueryResult(self.memory_store.chat_message_counts(self._memory_mask(), limit))
+        return self._run_query("active_chats", limit=limit)
 
+    @cached_query
     def get_recent_chats(self, limit=20):
-        query = """
-            SELECT CASE WHEN c.subject IS NOT NULL THEN c.subject ELSE j.user END, MAX(m.timestamp)
-            FROM chat c JOIN jid j ON c.jid_row_id = j._id JOIN message m ON c._id = m.chat_row_id
-            GROUP BY 1 ORDER BY 2 DESC LIMIT ?;
-        """
-        return self._fetch_data(query, (limit,))
+        return self._run_query("recent_chats", limit=limit)
 
+    @cached_query
     def get_ephemeral_chats(self):
-        query = """
-            SELECT j.user, c.subject, c.ephemeral_expiration
-            FROM chat c JOIN jid j ON c.jid_row_id = j._id WHERE c.ephemeral_expiration > 0
-        """
-        return self._fetch_data(query)
+        return self._run_query("ephemeral_chats")
 
+    @cached_query
     def get_all_text_messages(self):
-        query = "SELECT text_data FROM message WHERE text_data IS NOT NULL;"
-        return self._fetch_data(query)
+        return self._run_query("all_text_messages")
 
+    @cached_query
     def get_text_for_sentiment(self):
-        query = """
-            SELECT text_data FROM message
-            WHERE message_type = 0 AND LENGTH(TRIM(text_data)) > 10 AND text_data NOT LIKE '%<omit%'
-        """
-        return self._fetch_data(query)
+        return self._run_query("text_for_sentiment")
 
+    @cached_query
     def search_messages_by_word(self, word):
-        query = """
-            SELECT m.text_data, m.timestamp, m.from_me, s.user, r.user, c.subject
-            FROM message AS m
-            LEFT JOIN chat c ON m.chat_row_id = c._id
-            LEFT JOIN jid s ON m.sender_jid_row_id = s._id
-            LEFT JOIN jid r ON c.jid_row_id = r._id
-            WHERE m.text_data LIKE ? ORDER BY m.timestamp DESC LIMIT 100;
-        """
-        return self._fetch_data(query, (f"%{word}%",))
+        if self.memory_store is not None:
+            return QueryResult(self.memory_store.search(word, self._memory_mask()))
+        return self._run_query("search_messages_by_word", word=f"%{word}%")
 
+    @cached_query
     def search_onetime_messages(self, number):
-        query = """
-            SELECT
-                CASE WHEN c.subject IS NOT NULL THEN s.user ELSE r.user END, c.subject,
-                m.received_timestamp, m.text_data, m.message_type, m.from_me
-            FROM message m
-            JOIN chat c ON m.chat_row_id = c._id
-            JOIN jid r ON c.jid_row_id = r._id
-            LEFT JOIN jid s ON m.sender_jid_row_id = s._id
-            WHERE (r.user LIKE ? OR s.user LIKE ?) AND m.message_type IN (42, 43, 82)
-            ORDER BY m.received_timestamp DESC;
-        """
-        return self._fetch_data(query, (f"%{number}%", f"%{number}%"))
+        return self._run_query("onetime_messages", number=f"%{number}%")
 
+    @cached_query
     def search_locations_by_number(self, number):
-        query = """
-            SELECT j.user, ml.place_name, ml.place_address, ml.latitude, ml.longitude, m.timestamp
-            FROM message m
-            JOIN message_location ml ON m._id = ml.message_row_id
-            JOIN jid j ON m.sender_jid_row_id = j._id
-            WHERE j.user LIKE ? ORDER BY m.timestamp DESC LIMIT 100;
-        """
-        return self._fetch_data(query, (f"%{number}%",))
+        return self._run_query("locations_by_number", number=f"%{number}%")
         
+    @cached_query
     def search_latest_messages(self, search_key):
         is_phone = re.compile(r'^\+?\d{6,15}$').match(search_key)
-        query = """
-            SELECT
-                CASE WHEN c.subject IS NOT NULL THEN s.user ELSE r.user END, c.subject,
-                m.timestamp, m.text_data, m.from_me
-            FROM message m
-            JOIN chat c ON m.chat_row_id = c._id
-            JOIN jid r ON c.jid_row_id = r._id
-            LEFT JOIN jid s ON m.sender_jid_row_id = s._id
-        """
-        params = []
         if is_phone:
-            query += " WHERE (r.user = ? OR s.user = ?)"
-            params.extend([search_key, search_key])
-        else:
-            query += " WHERE c.subject LIKE ?"
-            params.append(f"%{search_key}%")
-        query += " ORDER BY m.timestamp DESC LIMIT 100"
-        return self._fetch_data(query, tuple(params))
+            return self._run_query("latest_messages", phone=search_key)
+        return self._run_query("latest_messages", group=f"%{search_key}%")
 
+    @cached_query
     def get_media_analysis_data(self):
-        query = """
-            SELECT mime_type, ROUND(AVG(CASE WHEN media_duration > 0 THEN media_duration END), 2), COUNT(*)
-            FROM message_media WHERE mime_type IS NOT NULL GROUP BY 1 HAVING COUNT(*) > 5 ORDER BY 3 DESC;
-        """
-        return self._fetch_data(query)
+        return self._run_query("media_analysis")
 
+    @cached_query
     def get_message_timestamps(self):
-        query = "SELECT timestamp FROM message WHERE timestamp IS NOT NULL"
-        return self._fetch_data(query)
+        return self._run_query("message_timestamps")
+
+    @cached_query
+    def get_contact_hourly_counts(self):
+        """Messaggi per (chat, mittente, ora UTC dall'epoch) in un unico GROUP BY; il fuso locale si applica dopo."""
+        return self._run_query("contact_hourly_counts", hour_len=3600 * self.timestamp_unit)
+
+    @cached_query
+    def get_chat_labels(self):
+        """Coppie (chiave chat, nome visualizzato) con le chiavi di get_contact_hourly_counts."""
+        return self._run_query("chat_labels")
+
+    @cached_query
+    def get_sender_labels(self):
+        """Coppie (chiave mittente, numero) con le chiavi di get_contact_hourly_counts."""
+        return self._run_query("sender_labels")
+
+    def detect_communication_anomalies(self, limit=200):
+        """Picchi, silenzi e cambi di orario per contatto (chat privata o partecipante di un gruppo) nell'ambito corrente."""
+        from anomaly_detection import detect_anomalies
+        rows = self.get_contact_hourly_counts()
+        anomalies = detect_anomalies(rows, self.get_chat_labels(), self.get_sender_labels(), limit=limit)
+        return QueryResult(anomalies, complete=rows.complete, truncated=rows.truncated, unsupported=rows.unsupported)
+
+    def get_timestamp_array(self):
+        """Timestamp dei messaggi nell'ambito come array NumPy int64 (dall'archivio in memoria se caricato)."""
+        import numpy as np
+        if self.memory_store is not None:
+            return self.memory_store.timestamps_in(self._memory_mask())
+        rows = self.get_message_timestamps()
+        return np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+
+    def get_joined_text(self):
+        """Testo di tutti i messaggi nell'ambito unito da spazi, per frequenze parole e WordCloud."""
+        if self.memory_store is not None:
+            return self.memory_store.joined_text(self._memory_mask())
+        return " ".join(row[0] for row in self.get_all_text_messages())
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+
+WAL_SUFFIXES = ("-wal", "-shm")
+# Nella home dell'utente e non nella temp di sistema condivisa: nessun altro utente può alterare la copia.
+SNAPSHOT_ROOT = os.path.join(os.path.expanduser("~"), ".whatsapp_forensic", "snapshots")
+MANIFEST_NAME = "manifest.json"
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def sha256_file(path):
+    """Calcola l'hash SHA-256 di un file leggendolo a blocchi."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SnapshotError(Exception):
+    """Sollevata quando la copia di lavoro non corrisponde alla fonte."""
+
+
+class EvidenceSnapshot:
+    """Prepara una copia di lavoro verificata del database da aprire con immutable=1.
+
+    Se accanto al database sono presenti i file -wal/-shm, il database viene copiato
+    in un'area di lavoro dell'utente, il WAL viene consolidato nella copia (mai nella fonte) e la
+    copia viene riutilizzata nelle sessioni successive finché l'hash della fonte non cambia
+    e l'hash della copia corrisponde ancora a quello registrato nel manifest.
+    """
+    def __init__(self, source_path, snapshot_root=SNAPSHOT_ROOT):
+        self.source_path = os.path.abspath(source_path)
+        self.snapshot_root = snapshot_root
+        self.sidecars = [self.source_path + s for s in WAL_SUFFIXES if os.path.exists(self.source_path + s)]
+        self.source_hashes = {}
+        self.snapshot_hash = None
+        self.path = self.source_path
+        self.reused = False
+
+    @property
+    def has_wal(self):
+        return bool(self.sidecars)
+
+    @property
+    def fingerprint(self):
+        """Hash combinato di database e file WAL, usato per identificare la fonte."""
+        digest = hashlib.sha256()
+        for name in sorted(self.source_hashes):
+            digest.update(f"{name}:{self.source_hashes[name]}".encode())
+        return digest.hexdigest()
+
+    def _hash_sources(self):
+        return {os.path.basename(p): sha256_file(p) for p in [self.source_path] + self.sidecars}
+
+    def prepare(self):
+        """Calcola gli hash della fonte e, se serve, crea o riusa la copia di lavoro."""
+        self.source_hashes = self._hash_sources()
+        if not self.has_wal:
+            # Nessun WAL: la fonte è già consistente e viene aperta direttamente in sola lettura.
+            self.snapshot_hash = self.source_hashes[os.path.basename(self.source_path)]
+            return self
+
+        work_dir = os.path.join(self.snapshot_root, self.fingerprint[:32])
+        snapshot_path = os.path.join(work_dir, os.path.basename(self.source_path))
+        manifest = self._read_manifest(work_dir)
+        if manifest and manifest.get("fingerprint") == self.fingerprint and os.path.exists(snapshot_path) \
+                and os.path.getsize(snapshot_path) == manifest.get("snapshot_size"):
+            # L'hash riportato deve descrivere il file effettivamente aperto: la copia viene ricalcolata.
+            snapshot_hash = sha256_file(snapshot_path)
+            if snapshot_hash == manifest.get("snapshot_hash"):
+                self.path, self.snapshot_hash, self.reused = snapshot_path, snapshot_hash, True
+                return self
+
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(self.snapshot_root, mode=0o700, exist_ok=True)
+        os.makedirs(work_dir, mode=0o700, exist_ok=True)
+        for src in [self.source_path] + self.sidecars:
+            shutil.copy2(src, os.path.join(work_dir, os.path.basename(src)))
+
+        # Verifica che la fonte non sia cambiata durante la copia.
+        if self._hash_sources() != self.source_hashes:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise SnapshotError("Il database sorgente è stato modificato durante la copia.")
+        for src in [self.source_path] + self.sidecars:
+            copy_path = os.path.join(work_dir, os.path.basename(src))
+            if sha256_file(copy_path) != self.source_hashes[os.path.basename(src)]:
+                shutil.rmtree(work_dir, ignore_errors=True)
+                raise SnapshotError(f"La copia di {os.path.basename(src)} non corrisponde all'originale.")
+
+        self._checkpoint(snapshot_path)
+        self.path = snapshot_path
+        self.snapshot_hash = sha256_file(snapshot_path)
+        self._write_manifest(work_dir, {
+            "source_path": self.source_path, "fingerprint": self.fingerprint,
+            "source_hashes": self.source_hashes, "snapshot_hash": self.snapshot_hash,
+            "snapshot_size": os.path.getsize(snapshot_path),
+        })
+        return self
+
+    def _checkpoint(self, snapshot_path):
+        """Consolida il WAL nella copia e la riporta in modalità rollback journal."""
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            conn.execute("PRAGMA journal_mode=DELETE;")
+        finally:
+            conn.close()
+        for suffix in WAL_SUFFIXES:
+            if os.path.exists(snapshot_path + suffix):
+                os.remove(snapshot_path + suffix)
+
+    def _read_manifest(self, work_dir):
+        try:
+            with open(os.path.join(work_dir, MANIFEST_NAME), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, work_dir, data):
+        with open(os.path.join(work_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
@@ -2,7 +2,8 @@ import os
 import webbrowser
 import io
 import base64
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 import warnings
 
 # Import per la GUI
@@ -14,12 +15,14 @@ from tkinter import PhotoImage
 
 # Import per l'analisi e il plotting
 import matplotlib.pyplot as plt
+from matplotlib.widgets import Slider
 import pandas as pd
 import numpy as np
 from collections import Counter
 from wordcloud import WordCloud
 import folium
 from textblob import TextBlob
+from dateutil.tz import tzlocal
 
 # Import per il report PDF
 from reportlab.pdfgen import canvas
@@ -32,7 +35,7 @@ from reportlab.lib import colors
 # Import per il clustering (opzionali)
 try:
     from sklearn.feature_extraction.text import TfidfVectorizer
-    from sklearn.cluster import KMeans
+    from sklearn.cluster import KMeans, MiniBatchKMeans
     from sklearn.decomposition import PCA
     from scipy.cluster.hierarchy import dendrogram, linkage
     import nltk
@@ -40,11 +43,21 @@ try:
 except ImportError:
     CLUSTERING_ENABLED = False
 
+# Parametri del clustering gerarchico su campioni estesi
+HIERARCHICAL_DEFAULT_SAMPLE = 20000
+HIERARCHICAL_MICRO_THRESHOLD = 500
+HIERARCHICAL_MAX_MICRO_CLUSTERS = 300
+
+# Dopo quanti secondi una query mostra la finestra per interromperla
+QUERY_DIALOG_DELAY = 1.0
+# Numero massimo di righe mostrate nelle liste di risultati non limitate dalla query
+DISPLAY_ROW_BUDGET = 10000
+
 # Ignora avvisi non critici
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-from database_manager import DatabaseManager
+from database_manager import DatabaseManager, AnalysisScope
 from icons import ICON_DATA
 
 class WhatsAppForensicsApp:
@@ -60,6 +73,13 @@ class WhatsAppForensicsApp:
         self.welcome_tab = None
         self.clustering_enabled = CLUSTERING_ENABLED
         self.nltk_stopwords_ready = False
+        self.disk_cache_var = BooleanVar(value=False)
+        self.memory_mode_var = BooleanVar(value=False)
+        self.analysis_scope = AnalysisScope()
+        self.hierarchical_cache = {}
+        self._query_started = None
+        self._query_dialog = None
+        self._last_event_pump = 0.0
 
         self._setup_styles_and_icons()
         self._create_widgets()
@@ -91,11 +111,23 @@ class WhatsAppForensicsApp:
         file_menu = Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="File", menu=file_menu)
         file_menu.add_command(label="Apri Database (msgstore.db)...", command=self._open_database)
+        file_menu.add_checkbutton(label="Cache Persistente su Disco", variable=self.disk_cache_var)
+        file_menu.add_checkbutton(label="Carica Messaggi in Memoria", variable=self.memory_mode_var, command=self._toggle_memory_mode)
+        file_menu.add_command(label="Svuota Cache dei Risultati", command=self._clear_result_cache)
         file_menu.add_separator()
         file_menu.add_command(label="Esci", command=self.root.quit)
-
-        self.status_bar = Label(self.root, text="Pronto. Aprire un database per iniziare.", bd=1, relief="sunken", anchor="w", padx=5)
-        self.status_bar.pack(side="bottom", fill="x")
+        scope_menu = Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="Ambito", menu=scope_menu)
+        scope_menu.add_command(label="Imposta Ambito di Analisi...", command=self._open_scope_window)
+        scope_menu.add_command(label="Rimuovi Ambito (intero database)", command=lambda: self._apply_scope(AnalysisScope()))
+
+        status_frame = Frame(self.root)
+        status_frame.pack(side="bottom", fill="x")
+        self.cache_status = Label(status_frame, text="", bd=1, relief="sunken", anchor="e", padx=5)
+        self.cache_status.pack(side="right")
+        self.status_bar = Label(status_frame, text="Pronto. Aprire un database per iniziare.", bd=1, relief="sunken", anchor="w", padx=5)
+        self.status_bar.pack(side="left", fill="x", expand=True)
+        self._refresh_cache_status()
 
         self.notebook = ttk.Notebook(self.root, padding=10)
         self.notebook.pack(expand=True, fill="both")
@@ -109,14 +141,120 @@ class WhatsAppForensicsApp:
         db_path = askopenfilename(title="Seleziona il database msgstore.db", filetypes=[("Database SQLite", "*.db"), ("Tutti i file", "*.*")])
         if db_path:
             try:
-                self.db_manager = DatabaseManager(db_path)
+                self.status_bar.config(text="Calcolo hash e preparazione copia di lavoro..."); self.root.update_idletasks()
+                self.db_manager = DatabaseManager(db_path, disk_cache=self.disk_cache_var.get())
+                self.db_manager.set_scope(self.analysis_scope)
+                self.db_manager.progress_callback = self._on_query_progress
+                if self.memory_mode_var.get(): self._toggle_memory_mode()
                 self.db_path = db_path
-                self.status_bar.config(text=f"Database caricato: {os.path.basename(db_path)}")
+                snapshot = self.db_manager.snapshot
+                mode = ("copia WAL riutilizzata" if snapshot.reused else "copia WAL consolidata") if snapshot.has_wal else "sola lettura"
+                self.status_bar.config(text=f"Database caricato: {os.path.basename(db_path)} ({mode}, schema {self.db_manager.schema_version}) | SHA-256: {snapshot.snapshot_hash[:16]}...")
                 self._populate_analysis_tabs()
             except Exception as e:
                 messagebox.showerror("Errore Inizializzazione", f"Impossibile inizializzare il database o le schede di analisi:\n{e}")
                 self.status_bar.config(text="Errore nel caricamento del database.")
 
+    def _toggle_memory_mode(self):
+        """Carica o rilascia l'archivio in memoria; se supera il limite le analisi restano su SQL."""
+        if self.db_manager is None: return
+        if not self.memory_mode_var.get():
+            self.db_manager.unload_memory()
+            return self.status_bar.config(text="Archivio in memoria rilasciato: le analisi usano SQL.")
+        self.status_bar.config(text="Caricamento dei messaggi in memoria..."); self.root.update_idletasks()
+        loaded, description = self.db_manager.load_into_memory()
+        if not loaded: self.memory_mode_var.set(False)
+        self.status_bar.config(text=description)
+
+    def _on_query_progress(self, done, truncated=False):
+        """Richiamata da DatabaseManager durante le query lunghe: mostra una finestra modale per interromperle."""
+        now = time.monotonic()
+        if done:
+            self._query_started = None
+            if self._query_dialog is not None:
+                self._query_dialog.grab_release(); self._query_dialog.destroy(); self._query_dialog = None
+            if truncated:
+                self.status_bar.config(text="Attenzione: risultati parziali.")
+                messagebox.showwarning("Risultati Parziali", "La query è stata interrotta o ha superato il limite di righe: i risultati mostrati sono parziali.")
+            return
+        if self._query_started is None:
+            self._query_started = now
+            return
+        if now - self._query_started < QUERY_DIALOG_DELAY or now - self._last_event_pump < 0.1:
+            return
+        if self._query_dialog is None:
+            dialog = Toplevel(self.root); dialog.title("Query in Corso"); dialog.geometry("320x110"); dialog.transient(self.root)
+            Label(dialog, text="Interrogazione del database in corso...", font=('Helvetica', 10)).pack(pady=10)
+            ttk.Button(dialog, text="Interrompi (Esc)", command=self.db_manager.cancel).pack(pady=5)
+            dialog.bind("<Escape>", lambda e: self.db_manager.cancel())
+            dialog.protocol("WM_DELETE_WINDOW", self.db_manager.cancel)
+            dialog.grab_set(); dialog.focus_set()
+            self._query_dialog = dialog
+        # La finestra modale impedisce di avviare altre analisi mentre si elaborano gli eventi.
+        self._last_event_pump = now
+        self.root.update()
+
+    def _refresh_cache_status(self):
+        if self.db_manager is not None:
+            self.cache_status.config(text=self.db_manager.cache.stats_text())
+        self.root.after(1000, self._refresh_cache_status)
+
+    def _clear_result_cache(self):
+        if self.db_manager is None: return
+        self.db_manager.cache.clear(disk=True)
+        self.status_bar.config(text="Cache dei risultati svuotata.")
+
+    def _parse_scope_date(self, value, end_of_range=False):
+        """Interpreta 'AAAA-MM-GG' o 'AAAA-MM-GG HH:MM'; una data di fine senza ora include l'intera giornata."""
+        value = value.strip()
+        if not value: return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M')
+        except ValueError:
+            day = datetime.strptime(value, '%Y-%m-%d')
+            return day + timedelta(days=1) if end_of_range else day
+
+    def _format_scope_end(self, end):
+        if not end: return ""
+        if (end.hour, end.minute) == (0, 0): return (end - timedelta(days=1)).strftime('%Y-%m-%d')
+        return end.strftime('%Y-%m-%d %H:%M')
+
+    def _open_scope_window(self):
+        top = Toplevel(self.root); top.title("Ambito di Analisi"); top.geometry("420x260")
+        frame = ttk.LabelFrame(top, text="Limita tutte le analisi e i report a")
+        frame.pack(fill="both", expand=True, padx=10, pady=10)
+        scope = self.analysis_scope
+        fields = [
+            ("start", "Data inizio (AAAA-MM-GG [HH:MM]):", scope.start.strftime('%Y-%m-%d %H:%M') if scope.start else ""),
+            ("end", "Data fine (AAAA-MM-GG [HH:MM]):", self._format_scope_end(scope.end)),
+            ("chat", "Chat / Gruppo (nome o numero):", scope.chat or ""),
+            ("contact", "Contatto (numero):", scope.contact or ""),
+        ]
+        entries = {}
+        for row, (key, label, value) in enumerate(fields):
+            Label(frame, text=label, font=('Helvetica', 9)).grid(row=row, column=0, sticky="w", padx=5, pady=4)
+            entry = ttk.Entry(frame, font=('Helvetica', 10)); entry.insert(0, value)
+            entry.grid(row=row, column=1, sticky="ew", padx=5, pady=4); entries[key] = entry
+        frame.columnconfigure(1, weight=1)
+        def apply():
+            try:
+                new_scope = AnalysisScope(start=self._parse_scope_date(entries["start"].get()),
+                                          end=self._parse_scope_date(entries["end"].get(), end_of_range=True),
+                                          chat=entries["chat"].get().strip(), contact=entries["contact"].get().strip())
+            except ValueError:
+                return messagebox.showwarning("Data non Valida", "Usare il formato AAAA-MM-GG oppure AAAA-MM-GG HH:MM.", parent=top)
+            if new_scope.start and new_scope.end and new_scope.start >= new_scope.end:
+                return messagebox.showwarning("Intervallo non Valido", "La data di inizio deve precedere la data di fine.", parent=top)
+            self._apply_scope(new_scope); top.destroy()
+        ttk.Button(top, text="Applica Ambito", command=apply, style="Accent.TButton").pack(pady=10, ipady=5)
+
+    def _apply_scope(self, scope):
+        self.analysis_scope = scope
+        if self.db_manager is not None:
+            self.db_manager.set_scope(scope)
+        self.root.title("WhatsApp Forensics Toolkit" if scope.is_empty() else f"WhatsApp Forensics Toolkit - Ambito: {scope.describe()}")
+        self.status_bar.config(text=f"Ambito di analisi: {scope.describe()}")
+
     def _populate_analysis_tabs(self):
         try:
             # Rimuove la welcome tab se esiste
@@ -187,6 +325,7 @@ class WhatsAppForensicsApp:
         search_word_frame.pack(fill="x", padx=10, pady=10)
         self.search_entry = ttk.Entry(search_word_frame, font=('Helvetica', 10))
         self.search_entry.pack(side="left", fill="x", expand=True, padx=5, ipady=4)
+        ttk.Button(search_word_frame, text=" Messaggi Simili", image=self.icons.get('search'), compound="left", command=self._search_similar_messages).pack(side="right", padx=5)
         ttk.Button(search_word_frame, text=" Cerca", image=self.icons.get('search'), compound="left", command=self._search_by_keyword).pack(side="right", padx=5)
 
         search_num_frame = ttk.LabelFrame(tab, text="Ricerca per Numero di Telefono o Nome Gruppo")
@@ -208,6 +347,8 @@ class WhatsAppForensicsApp:
         self._add_button(frame, "Analisi dei Tipi di Media", "media", self._plot_media_analysis)
         self._add_button(frame, "Timeline Messaggi", "timeline", self._plot_timeline)
         self._add_button(frame, "Heatmap delle Interazioni", "heatmap", self._plot_heatmap)
+        self._add_button(frame, "Anomalie di Comunicazione", "timeline", self._show_communication_anomalies)
+        self._add_button(frame, "Famiglie di Messaggi Inoltrati", "chat", self._show_message_families)
 
     def _create_report_tab(self):
         frame = self._create_tab_frame("Report", self.notebook)
@@ -265,6 +406,14 @@ class WhatsAppForensicsApp:
             return datetime.fromtimestamp(ts / unit).strftime('%Y-%m-%d %H:%M:%S')
         return default
 
+    def _is_unsupported(self, data):
+        """Avvisa se l'analisi non è disponibile per questo database, invece di mostrare "nessun risultato"."""
+        reason = getattr(data, "unsupported", None)
+        if reason:
+            messagebox.showinfo("Analisi Non Disponibile", reason)
+            self.status_bar.config(text="Analisi non disponibile per questo database.")
+        return bool(reason)
+
     def _create_results_window(self, title, data, is_text_content=False):
         if not data:
             messagebox.showinfo("Nessun Risultato", "La ricerca non ha prodotto risultati.")
@@ -297,6 +446,7 @@ class WhatsAppForensicsApp:
 
     def _plot_active_chats(self):
         data = self.db_manager.get_active_chats()
+        if self._is_unsupported(data): return
         if not data: return messagebox.showinfo("Informazione", "Nessuna chat attiva trovata.")
         def plot(fig):
             chat_ids, counts = zip(*data)
@@ -309,13 +459,16 @@ class WhatsAppForensicsApp:
     def _show_recent_chats(self):
         self.status_bar.config(text="Caricamento chat recenti...")
         data = self.db_manager.get_recent_chats()
+        if self._is_unsupported(data): return
         formatted = [f"{i}. {row[0]} (Ultimo: {self._format_timestamp(row[1])})" for i, row in enumerate(data, 1)]
         self._create_results_window("Ultime 20 Chat Attive", formatted)
         self.status_bar.config(text="Pronto.")
 
     def _show_deleted_messages(self, number=None):
-        self.status_bar.config(text="Ricerca messaggi cancellati...")
-        data = self.db_manager.get_deleted_messages(number)
+        self.status_bar.config(text="Ricerca messaggi cancellati..."); self.root.update_idletasks()
+        with self.db_manager.query_limits(max_rows=DISPLAY_ROW_BUDGET):
+            data = self.db_manager.get_deleted_messages(number)
+        if self._is_unsupported(data): return
         results = []
         for phone, group, msg_ts, rev_ts, from_me in data:
             direction = f"DA: Tu | A: {phone or 'Sconosciuto'}" if from_me else f"DA: {phone or 'Sconosciuto'} | A: Tu"
@@ -328,15 +481,16 @@ class WhatsAppForensicsApp:
     def _show_ephemeral_chats(self):
         self.status_bar.config(text="Caricamento chat effimere...")
         data = self.db_manager.get_ephemeral_chats()
+        if self._is_unsupported(data): return
         results = [f"{(f'GRUPPO: {g}' if g else f'NUMERO: {p}')} | TIMER: {int(e / 86400)} giorni" for p, g, e in data]
         self._create_results_window("Chat con Messaggi Effimeri", results)
         self.status_bar.config(text="Pronto.")
 
     def _plot_word_histogram(self, min_len=1):
         self.status_bar.config(text="Analisi frequenza parole...")
-        text_data = self.db_manager.get_all_text_messages()
-        if not text_data: return messagebox.showinfo("Informazione", "Nessun messaggio di testo trovato.")
-        words = " ".join(row[0] for row in text_data).lower().split()
+        text = self.db_manager.get_joined_text()
+        if not text: return messagebox.showinfo("Informazione", "Nessun messaggio di testo trovato.")
+        words = text.lower().split()
         if min_len > 1:
             words = [word.strip('.,!?()[]{}"\'') for word in words if len(word) >= min_len]
         if not words: return messagebox.showinfo("Informazione", "Nessuna parola trovata con i criteri specificati.")
@@ -351,9 +505,8 @@ class WhatsAppForensicsApp:
 
     def _plot_wordcloud(self):
         self.status_bar.config(text="Generazione WordCloud...")
-        text_data = self.db_manager.get_all_text_messages()
-        if not text_data: return messagebox.showinfo("Informazione", "Nessun testo per la WordCloud.")
-        text = " ".join(row[0] for row in text_data)
+        text = self.db_manager.get_joined_text()
+        if not text: return messagebox.showinfo("Informazione", "Nessun testo per la WordCloud.")
         words = [word.strip('.,!?()[]{}"\'') for word in text.lower().split() if len(word) >= 4]
         if not words: return messagebox.showinfo("Informazione", "Nessuna parola sufficiente per la WordCloud.")
         def plot(fig):
@@ -366,6 +519,7 @@ class WhatsAppForensicsApp:
     def _plot_sentiment(self):
         self.status_bar.config(text="Analisi sentiment...")
         data = self.db_manager.get_text_for_sentiment()
+        if self._is_unsupported(data): return
         if not data: return messagebox.showinfo("Informazione", "Nessun testo per l'analisi del sentiment.")
         sentiments = [TextBlob(row[0]).sentiment.polarity for row in data]
         def plot(fig):
@@ -376,24 +530,68 @@ class WhatsAppForensicsApp:
 
     def _perform_hierarchical_clustering(self):
         if not self._prepare_nltk_stopwords(): return
+        sample_size = askinteger("Dimensione Campione", "Numero massimo di messaggi da analizzare:", initialvalue=HIERARCHICAL_DEFAULT_SAMPLE, minvalue=2, maxvalue=200000)
+        if not sample_size: return
+        result = self._compute_hierarchical_linkage(sample_size)
+        if result is None: return
+        n_leaves = len(result["linkage"]) + 1
+        node_sizes = result["node_sizes"]
+        sliders = []  # riferimento al cursore finché la finestra è aperta
+        def draw(ax, p):
+            ax.clear()
+            dendrogram(result["linkage"], truncate_mode='lastp', p=p, orientation='top', distance_sort='descending',
+                       leaf_label_func=lambda node_id: f"({node_sizes[node_id]})", leaf_rotation=90, ax=ax)
+            ax.set_title(f"Dendrogramma del Clustering Gerarchico ({result['n_docs']} messaggi, {p} rami)")
+            ax.set_ylabel("Distanza"); ax.set_xlabel("Numero di messaggi per ramo")
+        def plot(fig):
+            grid = fig.add_gridspec(2, 1, height_ratios=[14, 1])
+            ax, slider_ax = fig.add_subplot(grid[0]), fig.add_subplot(grid[1])
+            # Il livello di taglio si cambia nella finestra stessa, ridisegnando il linkage già calcolato.
+            slider = Slider(slider_ax, "Rami", 2, n_leaves, valinit=min(30, n_leaves), valstep=1)
+            slider.on_changed(lambda value: (draw(ax, int(value)), fig.canvas.draw_idle()))
+            sliders.append(slider)
+            draw(ax, int(slider.val))
+        self._show_plot(plot, "Dendrogramma Gerarchico", figsize=(12, 7))
+        self.status_bar.config(text="Pronto.")
+
+    def _compute_hierarchical_linkage(self, sample_size):
+        """Calcola (o recupera dalla cache) la matrice di linkage per il campione richiesto.
+
+        Oltre HIERARCHICAL_MICRO_THRESHOLD messaggi il linkage ward viene calcolato sui centroidi
+        di micro-cluster MiniBatchKMeans invece che sulla matrice densa di tutti i messaggi.
+        """
         from nltk.corpus import stopwords
+        cache_key = (self.db_manager.fingerprint, self.db_manager.scope.key(), sample_size)
+        if cache_key in self.hierarchical_cache:
+            return self.hierarchical_cache[cache_key]
         self.status_bar.config(text="Avvio analisi gerarchica..."); self.root.update_idletasks()
-        message_data = self.db_manager.get_messages_for_clustering(limit=100)
+        message_data = self.db_manager.get_messages_for_clustering(limit=sample_size)
         if not message_data or len(message_data) < 2:
-            messagebox.showinfo("Dati Insufficienti", "Non ci sono abbastanza messaggi (min 2) per l'analisi."); self.status_bar.config(text="Pronto."); return
-        messagebox.showinfo("Nota", "Il clustering gerarchico verrà eseguito su un campione di max 100 messaggi per garantire la leggibilità del dendrogramma.")
+            messagebox.showinfo("Dati Insufficienti", "Non ci sono abbastanza messaggi (min 2) per l'analisi."); self.status_bar.config(text="Pronto."); return None
         self.status_bar.config(text="Vettorizzazione del testo..."); self.root.update_idletasks()
-        vectorizer = TfidfVectorizer(max_features=100, stop_words=stopwords.words('italian'))
         docs = [row[0] for row in message_data]
+        vectorizer = TfidfVectorizer(max_features=5000, min_df=2 if len(docs) >= 100 else 1, stop_words=stopwords.words('italian'))
         tfidf_matrix = vectorizer.fit_transform(docs)
+        if len(docs) > HIERARCHICAL_MICRO_THRESHOLD:
+            n_micro = min(HIERARCHICAL_MAX_MICRO_CLUSTERS, len(docs) // 2)
+            self.status_bar.config(text=f"Creazione di {n_micro} micro-cluster..."); self.root.update_idletasks()
+            micro = MiniBatchKMeans(n_clusters=n_micro, batch_size=2048, random_state=42, n_init=3).fit(tfidf_matrix)
+            leaf_sizes = np.bincount(micro.labels_, minlength=n_micro)
+            # I micro-cluster vuoti non partecipano al dendrogramma.
+            populated = leaf_sizes > 0
+            points, leaf_sizes = micro.cluster_centers_[populated], leaf_sizes[populated]
+        else:
+            points, leaf_sizes = tfidf_matrix.toarray(), np.ones(len(docs), dtype=int)
         self.status_bar.config(text="Calcolo del linkage..."); self.root.update_idletasks()
-        linked = linkage(tfidf_matrix.toarray(), method='ward')
-        def plot(fig):
-            ax = fig.add_subplot(111)
-            dendrogram(linked, orientation='top', distance_sort='descending', show_leaf_counts=True, ax=ax)
-            ax.set_title("Dendrogramma del Clustering Gerarchico"); ax.set_ylabel("Distanza")
-        self._show_plot(plot, "Dendrogramma Gerarchico", figsize=(12, 7))
-        self.status_bar.config(text="Pronto.")
+        linked = linkage(points, method='ward')
+        # Numero di messaggi sotto ogni nodo: foglie seguite dai nodi creati da ciascuna fusione.
+        node_sizes = np.concatenate([leaf_sizes, np.zeros(len(linked), dtype=int)])
+        for i, (left, right, _, _) in enumerate(linked):
+            node_sizes[len(leaf_sizes) + i] = node_sizes[int(left)] + node_sizes[int(right)]
+        result = {"linkage": linked, "node_sizes": node_sizes, "n_docs": len(docs)}
+        if len(self.hierarchical_cache) >= 4: self.hierarchical_cache.clear()
+        self.hierarchical_cache[cache_key] = result
+        return result
 
     def _perform_kmeans_clustering(self):
         if not self._prepare_nltk_stopwords(): return
@@ -438,15 +636,49 @@ class WhatsAppForensicsApp:
         if not word: return messagebox.showwarning("Input Mancante", "Inserisci una parola da cercare.")
         self.status_bar.config(text=f"Ricerca di '{word}'..."); self.root.update_idletasks()
         data = self.db_manager.search_messages_by_word(word)
+        if self._is_unsupported(data): return
         results = [f"{self._format_timestamp(ts)} | {(f'GRUPPO: {g} | DA: {s}' if g else f'DA: Tu | A: {r}' if from_me else f'DA: {s} | A: Tu')} | MSG: {txt}" for txt, ts, from_me, s, r, g in data]
         self._create_results_window(f"Risultati per '{word}'", results)
         self.status_bar.config(text="Pronto.")
 
+    def _ensure_near_duplicate_index(self):
+        """Carica o costruisce (solo la prima volta per questo database) l'indice dei messaggi simili."""
+        if self.db_manager.near_duplicate_index is not None: return True
+        def progress(done):
+            self.status_bar.config(text=f"Costruzione indice messaggi simili: {done} messaggi indicizzati..."); self.root.update_idletasks()
+        self.status_bar.config(text="Caricamento indice messaggi simili..."); self.root.update_idletasks()
+        try:
+            index = self.db_manager.load_near_duplicate_index(progress=progress)
+        except Exception as e:
+            messagebox.showerror("Errore Indice", f"Impossibile costruire l'indice dei messaggi simili:\n{e}")
+            self.status_bar.config(text="Errore nella costruzione dell'indice.")
+            return False
+        self.status_bar.config(text=f"Indice messaggi simili pronto: {len(index)} messaggi."); self.root.update_idletasks()
+        return True
+
+    def _search_similar_messages(self):
+        text = self.search_entry.get().strip()
+        if not text: return messagebox.showwarning("Input Mancante", "Inserisci il testo del messaggio da cercare.")
+        if not self._ensure_near_duplicate_index(): return
+        data = self.db_manager.find_similar_messages(text)
+        results = [f"SIMILARITÀ: {sim:.0%} | {self._format_timestamp(ts)} | {(f'GRUPPO: {g} | DA: {s}' if g else f'DA: Tu | A: {r}' if from_me else f'DA: {s} | A: Tu')} | MSG: {txt}" for sim, txt, ts, from_me, s, r, g in data]
+        self._create_results_window(f"Messaggi simili a '{text[:40]}'", results)
+        self.status_bar.config(text="Pronto.")
+
+    def _show_message_families(self):
+        if not self._ensure_near_duplicate_index(): return
+        data = self.db_manager.get_message_families()
+        results = [f"{i}. {size} messaggi in {n_chats} chat | DAL {self._format_timestamp(first)} AL {self._format_timestamp(last)} | CHAT: {chats} | MSG: {txt or '[testo non disponibile]'}"
+                   for i, (size, n_chats, first, last, txt, chats) in enumerate(data, 1)]
+        self._create_results_window("Famiglie di Messaggi Inoltrati (più diffuse)", results)
+        self.status_bar.config(text="Pronto.")
+
     def _search_latest_messages(self):
         key = self.number_entry.get().strip()
         if not key: return messagebox.showwarning("Input Mancante", "Inserisci un numero o nome gruppo.")
         self.status_bar.config(text=f"Ricerca ultimi messaggi per '{key}'..."); self.root.update_idletasks()
         data = self.db_manager.search_latest_messages(key)
+        if self._is_unsupported(data): return
         results = [f"{self._format_timestamp(ts)} | {(f'DA: Tu | GRUPPO: {g}' if from_me and g else f'DA: Tu | A: {n}' if from_me else f'DA: {n} | GRUPPO: {g}' if g else f'DA: {n} | A: Tu')} | TESTO: {txt or '[Media]'}" for n, g, ts, txt, from_me in data]
         self._create_results_window(f"Ultimi messaggi per '{key}'", results)
         self.status_bar.config(text="Pronto.")
@@ -459,7 +691,9 @@ class WhatsAppForensicsApp:
     def _search_onetime_messages(self):
         number = self.number_entry.get().strip()
         if not number: return messagebox.showwarning("Input Mancante", "Inserisci un numero.")
-        data = self.db_manager.search_onetime_messages(number)
+        with self.db_manager.query_limits(max_rows=DISPLAY_ROW_BUDGET):
+            data = self.db_manager.search_onetime_messages(number)
+        if self._is_unsupported(data): return
         type_map = {42: "IMMAGINE", 43: "VIDEO", 82: "AUDIO"}
         results = [f"{self._format_timestamp(ts)} | {(f'DA: Tu | A: {n}' if from_me else f'DA: {n} | A: Tu')} | TIPO: {type_map.get(tid, 'Sconosciuto')}" for n, g, ts, txt, tid, from_me in data]
         self._create_results_window(f"Messaggi 'Vedi una volta' per '{number}'", results)
@@ -468,6 +702,7 @@ class WhatsAppForensicsApp:
         number = self.number_entry.get().strip()
         if not number: return messagebox.showwarning("Input Mancante", "Inserisci un numero.")
         data = self.db_manager.search_locations_by_number(number)
+        if self._is_unsupported(data): return
         if not data: return messagebox.showinfo("Nessun Risultato", f"Nessuna posizione trovata per '{number}'.")
         map_center = [data[0][3], data[0][4]]
         m = folium.Map(location=map_center, zoom_start=13)
@@ -480,6 +715,7 @@ class WhatsAppForensicsApp:
 
     def _plot_media_analysis(self):
         data = self.db_manager.get_media_analysis_data()
+        if self._is_unsupported(data): return
         if not data: return messagebox.showinfo("Informazione", "Nessun dato media per l'analisi.")
         def plot(fig):
             types, _, counts = zip(*data)
@@ -489,10 +725,10 @@ class WhatsAppForensicsApp:
         self._show_plot(plot, "Analisi Media")
 
     def _plot_timeline(self):
-        timestamps = self.db_manager.get_message_timestamps()
-        if not timestamps: return messagebox.showinfo("Informazione", "Nessun messaggio per la timeline.")
-        unit = 'ms' if timestamps[0][0] > 1e12 else 's'
-        dates = pd.to_datetime([row[0] for row in timestamps], unit=unit).normalize()
+        timestamps = self.db_manager.get_timestamp_array()
+        if not len(timestamps): return messagebox.showinfo("Informazione", "Nessun messaggio per la timeline.")
+        unit = 'ms' if timestamps[0] > 1e12 else 's'
+        dates = pd.to_datetime(timestamps, unit=unit).normalize()
         date_range = pd.date_range(start=dates.min(), end=dates.max(), freq='D')
         counts = dates.value_counts().reindex(date_range, fill_value=0)
         def plot(fig):
@@ -501,16 +737,19 @@ class WhatsAppForensicsApp:
             ax.set_title("Timeline Messaggi"); fig.autofmt_xdate()
         self._show_plot(plot, "Timeline Messaggi", figsize=(14,7))
 
-    def _plot_heatmap(self):
-        timestamps = self.db_manager.get_message_timestamps()
-        if not timestamps: return messagebox.showinfo("Informazione", "Nessun dato per la heatmap.")
+    def _hour_weekday_counts(self, timestamps):
+        """Matrice 24x7 (ora locale x giorno della settimana) calcolata in modo vettoriale."""
+        unit = 'ms' if timestamps[0] > 1e12 else 's'
+        local = pd.to_datetime(timestamps, unit=unit, utc=True, errors='coerce').tz_convert(tzlocal())
+        valid = ~local.isna()
         heatmap_data = np.zeros((24, 7))
-        unit = 1000 if timestamps[0][0] > 1e12 else 1
-        for ts_tuple in timestamps:
-            try:
-                dt = datetime.fromtimestamp(ts_tuple[0] / unit)
-                heatmap_data[dt.hour, dt.weekday()] += 1
-            except (ValueError, OSError): continue
+        np.add.at(heatmap_data, (local.hour[valid].astype(int), local.weekday[valid].astype(int)), 1)
+        return heatmap_data
+
+    def _plot_heatmap(self):
+        timestamps = self.db_manager.get_timestamp_array()
+        if not len(timestamps): return messagebox.showinfo("Informazione", "Nessun dato per la heatmap.")
+        heatmap_data = self._hour_weekday_counts(timestamps)
         def plot(fig):
             ax = fig.add_subplot(111)
             im = ax.imshow(heatmap_data, cmap='YlOrRd', aspect='auto', origin='lower')
@@ -520,6 +759,21 @@ class WhatsAppForensicsApp:
             ax.set_title('Heatmap delle Interazioni')
         self._show_plot(plot, "Heatmap Interazioni")
 
+    def _show_communication_anomalies(self):
+        self.status_bar.config(text="Ricerca anomalie di comunicazione..."); self.root.update_idletasks()
+        try:
+            anomalies = self.db_manager.detect_communication_anomalies()
+        except Exception as e:
+            self.status_bar.config(text="Errore durante la ricerca delle anomalie.")
+            return messagebox.showerror("Errore Anomalie", f"Impossibile completare l'analisi:\n{e}")
+        if self._is_unsupported(anomalies): return
+        results = [f"{i}. [{a.kind}] {a.contact} | {a.start:%Y-%m-%d} -> {a.end:%Y-%m-%d} | "
+                   f"PUNTEGGIO: {a.score:.1f} | {a.detail}" for i, a in enumerate(anomalies, 1)]
+        if anomalies.truncated:
+            results.insert(0, "ATTENZIONE: serie incomplete, query interrotta prima del termine.")
+        self._create_results_window("Anomalie di Comunicazione per contatto (picchi, silenzi, cambi di orario)", results)
+        self.status_bar.config(text=f"Anomalie trovate: {len(anomalies)}.")
+
     def _generate_plot_to_buffer(self, plot_function, figsize):
         buffer = io.BytesIO()
         plt.style.use('seaborn-v0_8-whitegrid')
@@ -533,6 +787,7 @@ class WhatsAppForensicsApp:
 
     def _generate_active_chats_plot_for_pdf(self):
         data = self.db_manager.get_active_chats()
+        if getattr(data, 'unsupported', None): return Paragraph(data.unsupported, getSampleStyleSheet()['Normal'])
         if not data: return None
         def plot(fig):
             chat_ids, counts = zip(*data); ax = fig.add_subplot(111); ax.barh(chat_ids, counts, color='#075E54')
@@ -542,6 +797,7 @@ class WhatsAppForensicsApp:
 
     def _generate_media_analysis_plot_for_pdf(self):
         data = self.db_manager.get_media_analysis_data()
+        if getattr(data, 'unsupported', None): return Paragraph(data.unsupported, getSampleStyleSheet()['Normal'])
         if not data: return None
         def plot(fig):
             types, _, counts = zip(*data); ax = fig.add_subplot(111); ax.barh([t.split('/')[1] for t in types], counts, color='teal')
@@ -550,10 +806,10 @@ class WhatsAppForensicsApp:
         return Image(buffer, width=15*cm, height=7.5*cm)
 
     def _generate_timeline_plot_for_pdf(self):
-        timestamps = self.db_manager.get_message_timestamps()
-        if not timestamps: return None
-        unit = 'ms' if timestamps[0][0] > 1e12 else 's'
-        dates = pd.to_datetime([row[0] for row in timestamps], unit=unit).normalize()
+        timestamps = self.db_manager.get_timestamp_array()
+        if not len(timestamps): return None
+        unit = 'ms' if timestamps[0] > 1e12 else 's'
+        dates = pd.to_datetime(timestamps, unit=unit).normalize()
         counts = dates.value_counts().sort_index()
         def plot(fig):
             ax = fig.add_subplot(111); ax.plot(counts.index, counts.values, color='royalblue')
@@ -563,6 +819,7 @@ class WhatsAppForensicsApp:
         
     def _generate_sentiment_plot_for_pdf(self):
         data = self.db_manager.get_text_for_sentiment()
+        if getattr(data, 'unsupported', None): return Paragraph(data.unsupported, getSampleStyleSheet()['Normal'])
         if not data: return None
         sentiments = [TextBlob(row[0]).sentiment.polarity for row in data]
         def plot(fig):
@@ -572,12 +829,9 @@ class WhatsAppForensicsApp:
         return Image(buffer, width=15*cm, height=7.5*cm)
 
     def _generate_heatmap_plot_for_pdf(self):
-        timestamps = self.db_manager.get_message_timestamps()
-        if not timestamps: return None
-        heatmap_data = np.zeros((24, 7)); unit = 1000 if timestamps[0][0] > 1e12 else 1
-        for ts_tuple in timestamps:
-            try: dt = datetime.fromtimestamp(ts_tuple[0] / unit); heatmap_data[dt.hour, dt.weekday()] += 1
-            except (ValueError, OSError): continue
+        timestamps = self.db_manager.get_timestamp_array()
+        if not len(timestamps): return None
+        heatmap_data = self._hour_weekday_counts(timestamps)
         buffer = io.BytesIO()
         plt.style.use('seaborn-v0_8-whitegrid'); plt.figure(figsize=(8, 5)); ax = plt.subplot(111)
         im = ax.imshow(heatmap_data, cmap='YlOrRd', aspect='auto', origin='lower')
@@ -588,9 +842,8 @@ class WhatsAppForensicsApp:
         return Image(buffer, width=14*cm, height=8*cm)
         
     def _generate_wordcloud_plot_for_pdf(self):
-        text_data = self.db_manager.get_all_text_messages()
-        if not text_data: return None
-        text = " ".join(row[0] for row in text_data)
+        text = self.db_manager.get_joined_text()
+        if not text: return None
         words = [word.strip('.,!?()[]{}"\'') for word in text.lower().split() if len(word) >= 4]
         if not words: return None
         buffer = io.BytesIO()
@@ -633,6 +886,11 @@ class WhatsAppForensicsApp:
             story.append(Paragraph("Report di Analisi Forense WhatsApp", styles['h1']))
             story.append(Paragraph(f"File Analizzato: {os.path.basename(self.db_path)}", styles['Normal']))
             story.append(Paragraph(f"Data Report: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
+            for name, digest in self.db_manager.snapshot.source_hashes.items():
+                story.append(Paragraph(f"SHA-256 {name}: {digest}", styles['Normal']))
+            if self.db_manager.snapshot.has_wal:
+                story.append(Paragraph(f"SHA-256 copia di lavoro (WAL consolidato): {self.db_manager.snapshot.snapshot_hash}", styles['Normal']))
+            story.append(Paragraph(f"Ambito dell'Analisi: {self.db_manager.scope.describe()}", styles['Normal']))
             story.append(Spacer(1, 1*cm))
             stats = self.db_manager.get_summary_stats()
             story.append(Paragraph("Statistiche Riassuntive", styles['h2']))
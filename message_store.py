@@ -0,0 +1,192 @@
+import re
+
+import numpy as np
+
+DEFAULT_MEMORY_CAP = 1024 * 1024 * 1024
+LOAD_BATCH_SIZE = 50000
+SEARCH_BLOCK_ROWS = 4096
+# Byte per messaggio delle colonne numeriche: _id, timestamp, massimo progressivo, chat, mittente, tipo, from_me, offset.
+_BYTES_PER_ROW = 8 + 8 + 8 + 4 + 4 + 1 + 1 + 8
+TYPE_OTHER = 255
+# Un carattere UTF-8 diverso dal terminatore NUL, come il carattere jolly _ di LIKE.
+_LIKE_ANY_CHAR = rb"(?:[\x01-\x7f]|[\xc0-\xff][\x80-\xbf]*)"
+
+
+def like_pattern(word):
+    """Regex su byte equivalente a LIKE '%word%' di SQLite: % e _ jolly, maiuscole ignorate solo per ASCII.
+
+    La regex non attraversa mai il NUL tra due messaggi e consuma il resto del messaggio,
+    così restituisce al più una corrispondenza per riga.
+    """
+    parts = []
+    for char in word:
+        if char == "%":
+            parts.append(rb"[^\x00]*")
+        elif char == "_":
+            parts.append(_LIKE_ANY_CHAR)
+        else:
+            parts.append(re.escape(char.encode("utf-8", "surrogatepass")))
+    # re.IGNORECASE su pattern di byte confronta senza distinzione solo le lettere ASCII, come LIKE.
+    return re.compile(b"".join(parts) + rb"[^\x00]*", re.IGNORECASE)
+
+
+def _fill(buffer, pos, chunk):
+    """Copia chunk nel buffer preallocato da pos; lo ingrandisce solo se la stima iniziale era insufficiente."""
+    end = pos + len(chunk)
+    if end > len(buffer):
+        buffer += bytes(max(end - len(buffer), len(buffer) // 8))
+    buffer[pos:end] = chunk
+
+
+class MessageStore:
+    """Archivio in memoria dei messaggi in colonne compatte NumPy.
+
+    Timestamp int64, chat e mittente int32, tipo uint8 e testo in un unico buffer UTF-8
+    contiguo con offset: filtri, conteggi e istogrammi diventano operazioni vettoriali.
+    Ogni testo è terminato da un byte NUL; il buffer è preallocato sulla dimensione stimata
+    e riempito sul posto, senza copie finali.
+    """
+    def __init__(self, n_rows, text_bytes):
+        self.ids = np.empty(n_rows, dtype=np.int64)
+        self.timestamps = np.empty(n_rows, dtype=np.int64)
+        self.newest_before = None
+        self.chat_ids = np.empty(n_rows, dtype=np.int32)
+        self.sender_ids = np.empty(n_rows, dtype=np.int32)
+        self.types = np.empty(n_rows, dtype=np.uint8)
+        self.from_me = np.empty(n_rows, dtype=np.uint8)
+        self.has_text = np.empty(n_rows, dtype=bool)
+        self.text_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+        self.text_buffer = bytearray(text_bytes + n_rows)
+        self.chat_names = {}
+        self.chat_users = {}
+        self.jid_users = {}
+        self.n_rows = 0
+
+    @staticmethod
+    def estimate_bytes(n_rows, text_bytes):
+        """Stima dell'occupazione massima, anche durante il caricamento: colonne numeriche più il buffer di testo."""
+        return n_rows * (_BYTES_PER_ROW + 1) + text_bytes + n_rows
+
+    @classmethod
+    def build(cls, n_rows, text_bytes, row_batches, chats, jids):
+        """Costruisce l'archivio da blocchi di righe (_id, timestamp, chat, mittente, tipo, from_me, testo)."""
+        store = cls(n_rows, text_bytes)
+        for batch in row_batches:
+            store._append(batch)
+        store._finalize(chats, jids)
+        return store
+
+    def _append(self, batch):
+        start, end = self.n_rows, self.n_rows + len(batch)
+        if end > len(self.ids):
+            raise ValueError("Il numero di messaggi è cambiato durante il caricamento.")
+        ids, ts, chats, senders, types, from_me, texts = zip(*batch)
+        self.ids[start:end] = ids
+        self.timestamps[start:end] = [t or 0 for t in ts]
+        self.chat_ids[start:end] = [c if c is not None else -1 for c in chats]
+        self.sender_ids[start:end] = [s if s is not None else -1 for s in senders]
+        self.types[start:end] = [t if t is not None and 0 <= t < TYPE_OTHER else TYPE_OTHER for t in types]
+        self.from_me[start:end] = [1 if f else 0 for f in from_me]
+        self.has_text[start:end] = [t is not None for t in texts]
+        encoded = [t.encode("utf-8", "surrogatepass") + b"\x00" if t is not None else b"" for t in texts]
+        self.text_offsets[start + 1:end + 1] = self.text_offsets[start] + np.cumsum(list(map(len, encoded)))
+        _fill(self.text_buffer, int(self.text_offsets[start]), b"".join(encoded))
+        self.n_rows = end
+
+    def _finalize(self, chats, jids):
+        n = self.n_rows
+        for name in ("ids", "timestamps", "chat_ids", "sender_ids", "types", "from_me", "has_text"):
+            setattr(self, name, getattr(self, name)[:n])
+        self.text_offsets = self.text_offsets[:n + 1]
+        # Il ridimensionamento in coda avviene sul posto: nessuna seconda copia del buffer.
+        del self.text_buffer[int(self.text_offsets[n]):]
+        # Timestamp massimo fino a ogni riga: la ricerca si ferma quando le righe rimaste non possono essere più recenti.
+        self.newest_before = np.maximum.accumulate(self.timestamps) if n else self.timestamps
+        for chat_id, subject, user in chats:
+            self.chat_names[chat_id] = subject if subject is not None else user
+            self.chat_users[chat_id] = (subject, user)
+        self.jid_users = dict(jids)
+
+    @property
+    def nbytes(self):
+        arrays = (self.ids, self.timestamps, self.newest_before, self.chat_ids, self.sender_ids, self.types,
+                  self.from_me, self.has_text, self.text_offsets)
+        return sum(a.nbytes for a in arrays) + len(self.text_buffer)
+
+    def describe(self):
+        return f"{self.n_rows} messaggi in memoria ({self.nbytes / 1048576:.1f} MB)"
+
+    def text_at(self, i):
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i + 1] - 1].decode("utf-8", "surrogatepass")
+
+    def _matching_ids(self, names, pattern):
+        """Id (chiavi di names) il cui valore corrisponde a LIKE '%pattern%'."""
+        regex = like_pattern(pattern)
+        return np.fromiter((k for k, v in names.items() if v and regex.search(v.encode("utf-8", "surrogatepass"))), dtype=np.int64)
+
+    def scope_mask(self, scope, ts_unit):
+        """Maschera booleana dei messaggi inclusi nell'ambito di analisi."""
+        mask = np.ones(self.n_rows, dtype=bool)
+        if scope.start:
+            mask &= self.timestamps >= int(scope.start.timestamp() * ts_unit)
+        if scope.end:
+            mask &= self.timestamps < int(scope.end.timestamp() * ts_unit)
+        if scope.chat:
+            chat_labels = {k: f"{s or ''}\x00{u or ''}" for k, (s, u) in self.chat_users.items()}
+            mask &= np.isin(self.chat_ids, self._matching_ids(chat_labels, scope.chat))
+        if scope.contact:
+            private_chats = {k: u for k, (s, u) in self.chat_users.items() if s is None}
+            mask &= (np.isin(self.sender_ids, self._matching_ids(self.jid_users, scope.contact))
+                     | np.isin(self.chat_ids, self._matching_ids(private_chats, scope.contact)))
+        return mask
+
+    def timestamps_in(self, mask):
+        return self.timestamps[mask & (self.timestamps != 0)]
+
+    def joined_text(self, mask):
+        """Testo dei messaggi selezionati unito da spazi, decodificato in un'unica operazione."""
+        if mask.all():
+            return self.text_buffer[:-1].replace(b"\x00", b" ").decode("utf-8", "surrogatepass")
+        selected = np.flatnonzero(mask & self.has_text)
+        starts, ends = self.text_offsets[selected], self.text_offsets[selected + 1] - 1
+        return b" ".join(self.text_buffer[s:e] for s, e in zip(starts.tolist(), ends.tolist())).decode("utf-8", "surrogatepass")
+
+    def chat_message_counts(self, mask, limit):
+        """Equivalente di get_active_chats: conteggio per chat con bincount, raggruppato per nome."""
+        chat_ids = self.chat_ids[mask & (self.chat_ids >= 0)]
+        counts = np.bincount(chat_ids)
+        totals = {}
+        for chat_id in np.flatnonzero(counts).tolist():
+            if chat_id in self.chat_names:
+                name = self.chat_names[chat_id]
+                totals[name] = totals.get(name, 0) + int(counts[chat_id])
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def search(self, word, mask, limit=100):
+        """Equivalente di search_messages_by_word (LIKE '%word%', dal più recente, al più limit righe).
+
+        Il buffer è scandito a blocchi dall'ultima riga verso la prima e la scansione si ferma
+        quando nessuna riga rimasta può essere più recente delle limit già trovate.
+        """
+        pattern = like_pattern(word)
+        found = np.empty(0, dtype=np.int64)
+        for end in range(self.n_rows, 0, -SEARCH_BLOCK_ROWS):
+            start = max(end - SEARCH_BLOCK_ROWS, 0)
+            rows = np.arange(start, end)
+            rows = rows[mask[start:end] & self.has_text[start:end]]
+            if len(rows) and word.strip("%"):
+                positions = np.fromiter((m.start() for m in pattern.finditer(
+                    self.text_buffer, int(self.text_offsets[rows[0]]), int(self.text_offsets[rows[-1] + 1]))), dtype=np.int64)
+                matched = np.searchsorted(self.text_offsets, positions, side="right") - 1
+                rows = matched[mask[matched] & self.has_text[matched]]
+            if len(rows):
+                found = np.concatenate([found, rows])
+                found = found[np.argsort(-self.timestamps[found], kind="stable")][:limit]
+            if len(found) >= limit and start and self.timestamps[found[-1]] >= self.newest_before[start - 1]:
+                break
+        results = []
+        for i in found.tolist():
+            subject, chat_user = self.chat_users.get(int(self.chat_ids[i]), (None, None))
+            results.append((self.text_at(i), int(self.timestamps[i]), int(self.from_me[i]),
+                            self.jid_users.get(int(self.sender_ids[i])), chat_user, subject))
+        return results
@@ -0,0 +1,205 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Parametri della firma MinHash e delle bande LSH (soglia di collisione ~ (1/BANDS)^(1/ROWS) = 0.5)
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_SIZE = 5            # n-grammi di byte del testo normalizzato
+MIN_TEXT_LENGTH = 20        # i messaggi più corti sono troppo generici per essere confrontati
+DEFAULT_THRESHOLD = 0.5     # similarità di Jaccard stimata minima per la ricerca di messaggi simili
+FAMILY_THRESHOLD = 0.8      # più alta per le famiglie, per non concatenare testi solo vagamente simili
+BATCH_SIZE = 5000           # messaggi per blocco di calcolo (un blocco per processo)
+PERM_CHUNK = 16             # permutazioni calcolate insieme, per limitare la memoria del blocco
+INDEX_VERSION = 1
+INDEX_ROOT = os.path.join(os.path.expanduser("~"), ".whatsapp_forensic", "index")
+
+# Hash universali multiply-shift: ((a * x + b) mod 2^64) >> 32, senza divisioni.
+_rng = np.random.default_rng(20240611)
+_PERM_A = _rng.integers(0, 1 << 63, NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_PERM_B = _rng.integers(0, 1 << 63, NUM_PERM, dtype=np.uint64)
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_text(text):
+    """Minuscolo e punteggiatura/spazi compressi: copie inoltrate con piccole modifiche restano vicine."""
+    return _NON_WORD.sub(" ", text.lower()).strip()
+
+
+def minhash_signatures(texts):
+    """Firme MinHash (len(texts) x NUM_PERM, uint32) di testi già normalizzati e non vuoti.
+
+    Gli shingle di SHINGLE_SIZE byte sono calcolati in modo vettoriale su tutto il blocco:
+    nessun ciclo Python per shingle o per permutazione.
+    """
+    encoded = [t.encode("utf-8", "surrogatepass").ljust(SHINGLE_SIZE) for t in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    buf = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    n_shingles = lengths - SHINGLE_SIZE + 1
+    byte_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    starts = np.flatnonzero(np.arange(len(buf)) - byte_offsets < np.repeat(n_shingles, lengths))
+    shingles = np.zeros(len(starts), dtype=np.uint64)
+    for j in range(SHINGLE_SIZE):
+        shingles = (shingles << np.uint64(8)) | buf[starts + j].astype(np.uint64)
+    shingle_offsets = np.cumsum(n_shingles) - n_shingles
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    for p in range(0, NUM_PERM, PERM_CHUNK):
+        hashed = (_PERM_A[p:p + PERM_CHUNK, None] * shingles[None, :] + _PERM_B[p:p + PERM_CHUNK, None]) >> np.uint64(32)
+        signatures[:, p:p + PERM_CHUNK] = np.minimum.reduceat(hashed, shingle_offsets, axis=1).T
+    return signatures
+
+
+def band_keys(signatures):
+    """Chiave uint64 di ogni banda (n x BANDS) ottenuta combinando le ROWS_PER_BAND righe della firma."""
+    bands = signatures.reshape(len(signatures), BANDS, ROWS_PER_BAND).astype(np.uint64)
+    keys = np.zeros((len(signatures), BANDS), dtype=np.uint64)
+    for r in range(ROWS_PER_BAND):
+        keys = keys * np.uint64(0x100000001B3) ^ bands[:, :, r]
+    return keys
+
+
+def _signature_batch(rows):
+    """Blocco (id, chat, timestamp, testo) -> (id, chat, timestamp, firme) dei soli testi utilizzabili."""
+    kept, texts = [], []
+    for i, row in enumerate(rows):
+        text = normalize_text(row[3])
+        if len(text) >= MIN_TEXT_LENGTH:
+            kept.append(i); texts.append(text)
+    ids = np.fromiter((rows[i][0] for i in kept), dtype=np.int64, count=len(kept))
+    timestamps = np.fromiter((rows[i][2] or 0 for i in kept), dtype=np.int64, count=len(kept))
+    chats = [str(rows[i][1]) for i in kept]
+    signatures = minhash_signatures(texts) if texts else np.empty((0, NUM_PERM), dtype=np.uint32)
+    return ids, chats, timestamps, signatures
+
+
+def _connected_components(n, left, right):
+    """Etichette delle componenti connesse (union-find vettoriale con compressione dei cammini)."""
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[left], labels[right])
+        previous = labels.copy()
+        np.minimum.at(labels, left, low)
+        np.minimum.at(labels, right, low)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+class NearDuplicateIndex:
+    """Indice MinHash/LSH dei testi dei messaggi, salvato accanto alla cache come file .npz.
+
+    Per ogni banda le chiavi sono ordinate: i candidati di una ricerca si trovano con
+    searchsorted e vengono verificati confrontando le firme complete.
+    """
+    def __init__(self, ids, chat_idx, chat_keys, timestamps, signatures):
+        self.ids = ids
+        self.chat_idx = chat_idx
+        self.chat_keys = chat_keys
+        self.timestamps = timestamps
+        self.signatures = signatures
+        keys = band_keys(signatures).T
+        self.band_order = np.argsort(keys, axis=1, kind="stable").astype(np.int32)
+        self.band_keys = np.take_along_axis(keys, self.band_order, axis=1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def sidecar_path(fingerprint, index_dir=INDEX_ROOT):
+        return os.path.join(index_dir, f"{fingerprint[:32]}_minhash_v{INDEX_VERSION}.npz")
+
+    @classmethod
+    def build(cls, row_batches, workers=None, progress=None):
+        """Calcola le firme dei blocchi di righe (id, chat, timestamp, testo), in parallelo su più processi."""
+        workers = workers or os.cpu_count() or 1
+        results, done = [], 0
+
+        def collect(result):
+            nonlocal done
+            results.append(result)
+            done += len(result[0])
+            if progress: progress(done)
+
+        if workers == 1:
+            for batch in row_batches:
+                collect(_signature_batch(batch))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = []
+                for batch in row_batches:
+                    pending.append(executor.submit(_signature_batch, batch))
+                    # Al massimo due blocchi in attesa per processo: il testo non resta tutto in memoria.
+                    while len(pending) >= 2 * workers:
+                        collect(pending.pop(0).result())
+                for future in pending:
+                    collect(future.result())
+        results.append(_signature_batch([]))
+        chat_keys, chat_idx = np.unique(np.array([c for r in results for c in r[1]], dtype=str), return_inverse=True)
+        return cls(np.concatenate([r[0] for r in results]), chat_idx.astype(np.int32), chat_keys,
+                   np.concatenate([r[2] for r in results]), np.concatenate([r[3] for r in results]))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, version=INDEX_VERSION, num_perm=NUM_PERM, ids=self.ids, chat_idx=self.chat_idx,
+                 chat_keys=self.chat_keys, timestamps=self.timestamps, signatures=self.signatures)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Indice salvato in precedenza, o None se assente o generato con parametri diversi."""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data["version"]) != INDEX_VERSION or int(data["num_perm"]) != NUM_PERM:
+                    return None
+                return cls(data["ids"], data["chat_idx"], data["chat_keys"], data["timestamps"], data["signatures"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def query(self, signature, threshold=DEFAULT_THRESHOLD, mask=None):
+        """(righe, similarità) dei messaggi simili alla firma, in ordine di similarità decrescente."""
+        keys = band_keys(signature[None, :])[0]
+        lo = [np.searchsorted(self.band_keys[b], keys[b], side="left") for b in range(BANDS)]
+        hi = [np.searchsorted(self.band_keys[b], keys[b], side="right") for b in range(BANDS)]
+        candidates = np.unique(np.concatenate([self.band_order[b, lo[b]:hi[b]] for b in range(BANDS)]))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        similarity = (self.signatures[candidates] == signature).mean(axis=1)
+        keep = similarity >= threshold
+        candidates, similarity = candidates[keep], similarity[keep]
+        order = np.argsort(-similarity, kind="stable")
+        return candidates[order], similarity[order]
+
+    def query_text(self, text, threshold=DEFAULT_THRESHOLD, mask=None):
+        normalized = normalize_text(text)
+        if not normalized:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return self.query(minhash_signatures([normalized])[0], threshold, mask)
+
+    def families(self, threshold=FAMILY_THRESHOLD, mask=None, min_size=2, limit=50):
+        """Famiglie di messaggi quasi identici: componenti connesse delle coppie che collidono in una banda.
+
+        Restituisce gli array delle righe delle limit famiglie più numerose, dalla più grande.
+        """
+        selected = np.ones(len(self.ids), dtype=bool) if mask is None else mask
+        left, right = [], []
+        for b in range(BANDS):
+            in_scope = selected[self.band_order[b]]
+            order, keys = self.band_order[b][in_scope], self.band_keys[b][in_scope]
+            # Basta collegare gli elementi consecutivi di ogni bucket con la stessa chiave.
+            same = np.flatnonzero(keys[1:] == keys[:-1])
+            left.append(order[same]); right.append(order[same + 1])
+        left, right = np.concatenate(left).astype(np.int64), np.concatenate(right).astype(np.int64)
+        if not len(left):
+            return []
+        pairs = np.unique(np.stack([np.minimum(left, right), np.maximum(left, right)], axis=1), axis=0)
+        pairs = pairs[(self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]]).mean(axis=1) >= threshold]
+        labels = _connected_components(len(self.ids), pairs[:, 0], pairs[:, 1])
+        labels = np.where(selected, labels, -1)
+        sizes = np.bincount(labels[labels >= 0], minlength=len(self.ids))
+        big = np.flatnonzero(sizes >= min_size)
+        big = big[np.argsort(-sizes[big], kind="stable")][:limit]
+        return [np.flatnonzero(labels == label) for label in big.tolist()]
@@ -0,0 +1,384 @@
+import re
+import sqlite3
+from collections import namedtuple
+
+# Una query del catalogo: SQL con segnaposto {where} e clausole opzionali attivate per nome.
+# Alias comuni a tutte le varianti: m = messaggio, c = chat, r = jid della chat, s = jid del mittente.
+# scoped=False indica le query che non leggono i messaggi e ignorano l'ambito di analisi.
+CatalogQuery = namedtuple("CatalogQuery", ["sql", "filters", "scoped"], defaults=[{}, True])
+
+SCHEMA_MODERN = "modern"
+SCHEMA_LEGACY = "legacy"
+
+_PARAM_RE = re.compile(r":(\w+)")
+_SCHEMA_CACHE = {}
+
+# Schema attuale (tabelle message/chat/jid).
+MODERN_QUERIES = {
+    "messages_for_clustering": [CatalogQuery("""
+        SELECT m.text_data FROM message m
+        WHERE m.text_data IS NOT NULL AND LENGTH(TRIM(m.text_data)) > 25 AND m.message_type = 0 AND {where}
+        LIMIT :limit
+    """)],
+    "deleted_messages": [CatalogQuery("""
+        SELECT
+            CASE WHEN c.subject IS NOT NULL THEN s.user ELSE r.user END,
+            c.subject, m.timestamp, mr.revoke_timestamp, m.from_me
+        FROM message_revoked mr
+        JOIN message m ON m._id = mr.message_row_id
+        JOIN chat c ON m.chat_row_id = c._id
+        JOIN jid r ON c.jid_row_id = r._id
+        LEFT JOIN jid s ON m.sender_jid_row_id = s._id
+        WHERE {where} ORDER BY m.timestamp DESC
+    """, {"number": "(r.user LIKE :number OR s.user LIKE :number)"})],
+    # Rilevamento dell'unità dei timestamp all'apertura: MAX() risolto dall'indice sul timestamp.
+    "max_timestamp": [CatalogQuery("""
+        SELECT MAX(m.timestamp) FROM message m WHERE {where}
+    """, scoped=False)],
+    "summary_stats": [CatalogQuery("""
+        SELECT
+            (SELECT COUNT(*) FROM message m WHERE {where}),
+            (SELECT COUNT(*) FROM chat),
+            (SELECT MIN(m.timestamp) FROM message m WHERE m.timestamp > 0 AND {where}),
+            (SELECT MAX(m.timestamp) FROM message m WHERE m.timestamp > 0 AND {where})
+    """)],
+    # Variante preferita: aggrega per chat_row_id sull'indice prima di risolvere i nomi.
+    "active_chats": [CatalogQuery("""
+        SELECT CASE WHEN c.subject IS NOT NULL THEN c.subject ELSE r.user END, SUM(x.n)
+        FROM (SELECT m.chat_row_id, COUNT(*) AS n FROM message m WHERE {where} GROUP BY m.chat_row_id) x
+        JOIN chat c ON x.chat_row_id = c._id
+        JOIN jid r ON c.jid_row_id = r._id
+        GROUP BY 1 ORDER BY 2 DESC LIMIT :limit
+    """), CatalogQuery("""
+        SELECT CASE WHEN c.subject IS NOT NULL THEN c.subject ELSE r.user END, COUNT(m._id)
+        FROM chat c JOIN jid r ON c.jid_row_id = r._id JOIN message m ON c._id = m.chat_row_id
+        WHERE {where} GROUP BY 1 ORDER BY 2 DESC LIMIT :limit
+    """)],
+    "recent_chats": [CatalogQuery("""
+        SELECT CASE WHEN c.subject IS NOT NULL THEN c.subject ELSE r.user END, MAX(x.last_ts)
+        FROM (SELECT m.chat_row_id, MAX(m.timestamp) AS last_ts FROM message m WHERE {where} GROUP BY m.chat_row_id) x
+        JOIN chat c ON x.chat_row_id = c._id
+        JOIN jid r ON c.jid_row_id = r._id
+        GROUP BY 1 ORDER BY 2 DESC LIMIT :limit
+    """), CatalogQuery("""
+        SELECT CASE WHEN c.subject IS NOT NULL THEN c.subject ELSE r.user END, MAX(m.timestamp)
+        FROM chat c JOIN jid r ON c.jid_row_id = r._id JOIN message m ON c._id = m.chat_row_id
+        WHERE {where} GROUP BY 1 ORDER BY 2 DESC LIMIT :limit
+    """)],
+    "ephemeral_chats": [CatalogQuery("""
+        SELECT r.user, c.subject, c.ephemeral_expiration
+        FROM chat c JOIN jid r ON c.jid_row_id = r._id WHERE c.ephemeral_expiration > 0 AND {where}
+    """, scoped=False)],
+    "all_text_messages": [CatalogQuery("""
+        SELECT m.text_data FROM message m WHERE m.text_data IS NOT NULL AND {where}
+    """)],
+    "text_for_sentiment": [CatalogQuery("""
+        SELECT m.text_data FROM message m
+        WHERE m.message_type = 0 AND LENGTH(TRIM(m.text_data)) > 10 AND m.text_data NOT LIKE '%<omit%' AND {where}
+    """)],
+    "search_messages_by_word": [CatalogQuery("""
+        SELECT m.text_data, m.timestamp, m.from_me, s.user, r.user, c.subject
+        FROM message m
+        LEFT JOIN chat c ON m.chat_row_id = c._id
+        LEFT JOIN jid s ON m.sender_jid_row_id = s._id
+        LEFT JOIN jid r ON c.jid_row_id = r._id
+        WHERE m.text_data LIKE :word AND {where} ORDER BY m.timestamp DESC LIMIT 100
+    """)],
+    "onetime_messages": [CatalogQuery("""
+        SELECT
+            CASE WHEN c.subject IS NOT NULL THEN s.user ELSE r.user END, c.subject,
+            m.received_timestamp, m.text_data, m.message_type, m.from_me
+        FROM message m
+        JOIN chat c ON m.chat_row_id = c._id
+        JOIN jid r ON c.jid_row_id = r._id
+        LEFT JOIN jid s ON m.sender_jid_row_id = s._id
+        WHERE (r.user LIKE :number OR s.user LIKE :number) AND m.message_type IN (42, 43, 82) AND {where}
+        ORDER BY m.received_timestamp DESC
+    """)],
+    "locations_by_number": [CatalogQuery("""
+        SELECT s.user, ml.place_name, ml.place_address, ml.latitude, ml.longitude, m.timestamp
+        FROM message m
+        JOIN message_location ml ON m._id = ml.message_row_id
+        JOIN jid s ON m.sender_jid_row_id = s._id
+        WHERE s.user LIKE :number AND {where} ORDER BY m.timestamp DESC LIMIT 100
+    """)],
+    "latest_messages": [CatalogQuery("""
+        SELECT
+            CASE WHEN c.subject IS NOT NULL THEN s.user ELSE r.user END, c.subject,
+            m.timestamp, m.text_data, m.from_me
+        FROM message m
+        JOIN chat c ON m.chat_row_id = c._id
+        JOIN jid r ON c.jid_row_id = r._id
+        LEFT JOIN jid s ON m.sender_jid_row_id = s._id
+        WHERE {where} ORDER BY m.timestamp DESC LIMIT 100
+    """, {"phone": "(r.user = :phone OR s.user = :phone)", "group": "c.subject LIKE :group"})],
+    "media_analysis": [CatalogQuery("""
+        SELECT mm.mime_type, ROUND(AVG(CASE WHEN mm.media_duration > 0 THEN mm.media_duration END), 2), COUNT(*)
+        FROM message_media mm LEFT JOIN message m ON m._id = mm.message_row_id
+        WHERE mm.mime_type IS NOT NULL AND {where} GROUP BY 1 HAVING COUNT(*) > 5 ORDER BY 3 DESC
+    """)],
+    "message_timestamps": [CatalogQuery("""
+        SELECT m.timestamp FROM message m WHERE m.timestamp IS NOT NULL AND {where}
+    """)],
+    # Serie orarie UTC per chat e mittente in un solo passaggio raggruppato (anomaly_detection).
+    # Il mittente è NULL per i messaggi propri e per quelli delle chat private.
+    "contact_hourly_counts": [CatalogQuery("""
+        SELECT m.chat_row_id, CASE WHEN m.from_me = 0 THEN NULLIF(m.sender_jid_row_id, 0) END, m.timestamp / :hour_len, COUNT(*)
+        FROM message m WHERE m.timestamp > 0 AND {where} GROUP BY 1, 2, 3
+    """)],
+    "sender_labels": [CatalogQuery("""
+        SELECT r._id, r.user FROM jid r WHERE {where}
+    """, scoped=False)],
+    "chat_labels": [CatalogQuery("""
+        SELECT c._id, CASE WHEN c.subject IS NOT NULL THEN c.subject ELSE r.user END
+        FROM chat c JOIN jid r ON c.jid_row_id = r._id WHERE {where}
+    """, scoped=False)],
+    # Caricamento dell'archivio in memoria (message_store): sempre sull'intero database.
+    "memory_store_size": [CatalogQuery("""
+        SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(m.text_data AS BLOB))), 0) FROM message m WHERE {where}
+    """, scoped=False)],
+    "memory_store_rows": [CatalogQuery("""
+        SELECT m._id, m.timestamp, m.chat_row_id, m.sender_jid_row_id, m.message_type, m.from_me, m.text_data
+        FROM message m WHERE {where} ORDER BY m._id
+    """, scoped=False)],
+    "memory_store_chats": [CatalogQuery("""
+        SELECT c._id, c.subject, r.user FROM chat c JOIN jid r ON c.jid_row_id = r._id WHERE {where}
+    """, scoped=False)],
+    "memory_store_jids": [CatalogQuery("""
+        SELECT r._id, r.user FROM jid r WHERE {where}
+    """, scoped=False)],
+    # Indice dei messaggi quasi duplicati (near_duplicates): costruito sull'intero database,
+    # l'ambito si applica ai risultati tramite gli id.
+    "near_duplicate_texts": [CatalogQuery("""
+        SELECT m._id, m.chat_row_id, m.timestamp, m.text_data FROM message m
+        WHERE m.text_data IS NOT NULL AND LENGTH(m.text_data) >= :min_length AND {where} ORDER BY m._id
+    """, scoped=False)],
+    "near_duplicate_scope_ids": [CatalogQuery("""
+        SELECT m._id FROM message m WHERE {where}
+    """)],
+    "near_duplicate_details": [CatalogQuery("""
+        SELECT m._id, m.text_data, m.timestamp, m.from_me, s.user, r.user, c.subject
+        FROM message m
+        LEFT JOIN chat c ON m.chat_row_id = c._id
+        LEFT JOIN jid s ON m.sender_jid_row_id = s._id
+        LEFT JOIN jid r ON c.jid_row_id = r._id
+        WHERE m._id IN (SELECT value FROM json_each(:ids)) AND {where}
+    """)],
+}
+
+# Backup meno recenti (tabella messages con key_remote_jid, data, media_wa_type).
+_LEGACY_USER = "substr({col}, 1, instr({col}, '@') - 1)"
+_LEGACY_CHAT_USER = _LEGACY_USER.format(col="m.key_remote_jid")
+_LEGACY_SENDER = _LEGACY_USER.format(col="m.remote_resource")
+_LEGACY_CHAT_NAME = f"COALESCE(c.subject, {_LEGACY_CHAT_USER})"
+
+LEGACY_QUERIES = {
+    "messages_for_clustering": [CatalogQuery("""
+        SELECT m.data FROM messages m
+        WHERE m.data IS NOT NULL AND LENGTH(TRIM(m.data)) > 25 AND m.media_wa_type = 0 AND {where}
+        LIMIT :limit
+    """)],
+    # Nei backup legacy un messaggio revocato resta come media_wa_type = 15, senza data di revoca.
+    "deleted_messages": [CatalogQuery(f"""
+        SELECT
+            CASE WHEN c.subject IS NOT NULL THEN {_LEGACY_SENDER} ELSE {_LEGACY_CHAT_USER} END,
+            c.subject, m.timestamp, NULL, m.key_from_me
+        FROM messages m
+        LEFT JOIN chat_list c ON c.key_remote_jid = m.key_remote_jid
+        WHERE m.media_wa_type = 15 AND {{where}} ORDER BY m.timestamp DESC
+    """, {"number": "(m.key_remote_jid LIKE :number OR m.remote_resource LIKE :number)"})],
+    "max_timestamp": [CatalogQuery("""
+        SELECT MAX(m.timestamp) FROM messages m WHERE {where}
+    """, scoped=False)],
+    "summary_stats": [CatalogQuery("""
+        SELECT
+            (SELECT COUNT(*) FROM messages m WHERE {where}),
+            (SELECT COUNT(*) FROM chat_list),
+            (SELECT MIN(m.timestamp) FROM messages m WHERE m.timestamp > 0 AND {where}),
+            (SELECT MAX(m.timestamp) FROM messages m WHERE m.timestamp > 0 AND {where})
+    """)],
+    "active_chats": [CatalogQuery(f"""
+        SELECT {_LEGACY_CHAT_NAME}, COUNT(*)
+        FROM messages m LEFT JOIN chat_list c ON c.key_remote_jid = m.key_remote_jid
+        WHERE {{where}} GROUP BY 1 ORDER BY 2 DESC LIMIT :limit
+    """)],
+    "recent_chats": [CatalogQuery(f"""
+        SELECT {_LEGACY_CHAT_NAME}, MAX(m.timestamp)
+        FROM messages m LEFT JOIN chat_list c ON c.key_remote_jid = m.key_remote_jid
+        WHERE {{where}} GROUP BY 1 ORDER BY 2 DESC LIMIT :limit
+    """)],
+    "ephemeral_chats": [CatalogQuery(f"""
+        SELECT {_LEGACY_USER.format(col="c.key_remote_jid")}, c.subject, c.ephemeral_expiration
+        FROM chat_list c WHERE c.ephemeral_expiration > 0 AND {{where}}
+    """, scoped=False)],
+    "all_text_messages": [CatalogQuery("""
+        SELECT m.data FROM messages m WHERE m.data IS NOT NULL AND {where}
+    """)],
+    "text_for_sentiment": [CatalogQuery("""
+        SELECT m.data FROM messages m
+        WHERE m.media_wa_type = 0 AND LENGTH(TRIM(m.data)) > 10 AND m.data NOT LIKE '%<omit%' AND {where}
+    """)],
+    "search_messages_by_word": [CatalogQuery(f"""
+        SELECT m.data, m.timestamp, m.key_from_me, {_LEGACY_SENDER}, {_LEGACY_CHAT_USER}, c.subject
+        FROM messages m LEFT JOIN chat_list c ON c.key_remote_jid = m.key_remote_jid
+        WHERE m.data LIKE :word AND {{where}} ORDER BY m.timestamp DESC LIMIT 100
+    """)],
+    "locations_by_number": [CatalogQuery(f"""
+        SELECT COALESCE({_LEGACY_SENDER}, {_LEGACY_CHAT_USER}), m.media_name, NULL, m.latitude, m.longitude, m.timestamp
+        FROM messages m
+        WHERE m.media_wa_type = 5 AND (m.key_remote_jid LIKE :number OR m.remote_resource LIKE :number) AND {{where}}
+        ORDER BY m.timestamp DESC LIMIT 100
+    """)],
+    "latest_messages": [CatalogQuery(f"""
+        SELECT
+            CASE WHEN c.subject IS NOT NULL THEN {_LEGACY_SENDER} ELSE {_LEGACY_CHAT_USER} END, c.subject,
+            m.timestamp, m.data, m.key_from_me
+        FROM messages m LEFT JOIN chat_list c ON c.key_remote_jid = m.key_remote_jid
+        WHERE {{where}} ORDER BY m.timestamp DESC LIMIT 100
+    """, {"phone": f"({_LEGACY_CHAT_USER} = :phone OR {_LEGACY_SENDER} = :phone)", "group": "c.subject LIKE :group"})],
+    "media_analysis": [CatalogQuery("""
+        SELECT m.media_mime_type, ROUND(AVG(CASE WHEN m.media_duration > 0 THEN m.media_duration END), 2), COUNT(*)
+        FROM messages m WHERE m.media_mime_type IS NOT NULL AND {where} GROUP BY 1 HAVING COUNT(*) > 5 ORDER BY 3 DESC
+    """)],
+    "message_timestamps": [CatalogQuery("""
+        SELECT m.timestamp FROM messages m WHERE m.timestamp IS NOT NULL AND {where}
+    """)],
+    "contact_hourly_counts": [CatalogQuery("""
+        SELECT m.key_remote_jid, CASE WHEN m.key_from_me = 0 AND m.remote_resource != '' THEN m.remote_resource END,
+               m.timestamp / :hour_len, COUNT(*)
+        FROM messages m WHERE m.timestamp > 0 AND {where} GROUP BY 1, 2, 3
+    """)],
+    "sender_labels": [CatalogQuery(f"""
+        SELECT DISTINCT m.remote_resource, {_LEGACY_SENDER} FROM messages m WHERE m.remote_resource != '' AND {{where}}
+    """, scoped=False)],
+    "chat_labels": [CatalogQuery(f"""
+        SELECT c.key_remote_jid, COALESCE(c.subject, {_LEGACY_USER.format(col="c.key_remote_jid")})
+        FROM chat_list c WHERE {{where}}
+    """, scoped=False)],
+    "near_duplicate_texts": [CatalogQuery("""
+        SELECT m._id, m.key_remote_jid, m.timestamp, m.data FROM messages m
+        WHERE m.data IS NOT NULL AND LENGTH(m.data) >= :min_length AND {where} ORDER BY m._id
+    """, scoped=False)],
+    "near_duplicate_scope_ids": [CatalogQuery("""
+        SELECT m._id FROM messages m WHERE {where}
+    """)],
+    "near_duplicate_details": [CatalogQuery(f"""
+        SELECT m._id, m.data, m.timestamp, m.key_from_me, {_LEGACY_SENDER}, {_LEGACY_CHAT_USER}, c.subject
+        FROM messages m LEFT JOIN chat_list c ON c.key_remote_jid = m.key_remote_jid
+        WHERE m._id IN (SELECT value FROM json_each(:ids)) AND {{where}}
+    """)],
+}
+
+SCHEMA_QUERIES = {SCHEMA_MODERN: MODERN_QUERIES, SCHEMA_LEGACY: LEGACY_QUERIES}
+
+# Clausole dell'ambito di analisi, applicate a ogni query con scoped=True.
+# L'intervallo temporale usa predicati di range su m.timestamp, compatibili con l'indice.
+SCOPE_FILTERS = {
+    SCHEMA_MODERN: {
+        "scope_start": "m.timestamp >= :scope_start",
+        "scope_end": "m.timestamp < :scope_end",
+        "scope_chat": """m.chat_row_id IN (SELECT sc._id FROM chat sc JOIN jid sj ON sc.jid_row_id = sj._id
+                          WHERE sc.subject LIKE :scope_chat OR sj.user LIKE :scope_chat)""",
+        "scope_contact": """(m.sender_jid_row_id IN (SELECT _id FROM jid WHERE user LIKE :scope_contact)
+                          OR m.chat_row_id IN (SELECT sc._id FROM chat sc JOIN jid sj ON sc.jid_row_id = sj._id
+                                               WHERE sc.subject IS NULL AND sj.user LIKE :scope_contact))""",
+    },
+    SCHEMA_LEGACY: {
+        "scope_start": "m.timestamp >= :scope_start",
+        "scope_end": "m.timestamp < :scope_end",
+        "scope_chat": """(m.key_remote_jid LIKE :scope_chat
+                          OR m.key_remote_jid IN (SELECT key_remote_jid FROM chat_list WHERE subject LIKE :scope_chat))""",
+        "scope_contact": """(m.remote_resource LIKE :scope_contact
+                          OR (m.key_remote_jid NOT LIKE '%@g.us' AND m.key_remote_jid LIKE :scope_contact))""",
+    },
+}
+
+
+class UnsupportedSchemaError(Exception):
+    """Sollevata quando il database non corrisponde a nessuno schema WhatsApp noto."""
+
+
+def detect_schema(conn, cache_key=None):
+    """Individua la generazione dello schema tramite sqlite_master (risultato memorizzato per cache_key)."""
+    if cache_key is not None and cache_key in _SCHEMA_CACHE:
+        return _SCHEMA_CACHE[cache_key]
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    if {"message", "chat", "jid"} <= tables:
+        version = SCHEMA_MODERN
+    elif "messages" in tables:
+        version = SCHEMA_LEGACY
+    else:
+        raise UnsupportedSchemaError("Schema del database non riconosciuto: tabelle 'message' o 'messages' assenti.")
+    if cache_key is not None:
+        _SCHEMA_CACHE[cache_key] = version
+    return version
+
+
+# Righe del piano che leggono per intero la tabella dei messaggi (alias m o nome della tabella).
+_MESSAGE_SCAN_RE = re.compile(r"^SCAN (TABLE )?(m|message|messages)( AS m)?\b")
+
+
+def _plan_cost(plan):
+    """Costo di un piano: (scansioni complete di message, scansioni di message su indice)."""
+    scans = [row[-1] for row in plan if _MESSAGE_SCAN_RE.match(row[-1])]
+    covered = sum(1 for detail in scans if "USING" in detail)
+    return len(scans) - covered, covered
+
+
+class QueryCatalog:
+    """Seleziona e valida, una volta all'apertura, le query adatte allo schema del database."""
+    def __init__(self, conn, cache_key=None):
+        self.schema_version = detect_schema(conn, cache_key)
+        self.scope_filters = SCOPE_FILTERS[self.schema_version]
+        self.queries = {}
+        self.plans = {}
+        self.unavailable = {}
+        for name, candidates in SCHEMA_QUERIES[self.schema_version].items():
+            self._select(conn, name, candidates)
+
+    def _select(self, conn, name, candidates):
+        """Tra le varianti che SQLite accetta sceglie quella il cui piano legge meno volte per intero
+        la tabella dei messaggi (SEARCH su indice invece di SCAN); a parità vale l'ordine di preferenza.
+
+        Il piano è calcolato con tutti i filtri attivi, come nelle query con ambito.
+        """
+        best, errors = None, []
+        for order, candidate in enumerate(candidates):
+            sql = self._render(candidate, list(candidate.filters) + list(self._scope_names(candidate)))
+            params = {p: None for p in _PARAM_RE.findall(sql)}
+            try:
+                plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            except sqlite3.Error as e:
+                errors.append(str(e))
+                continue
+            cost = _plan_cost(plan) + (order,)
+            if best is None or cost < best[0]:
+                best = (cost, candidate, plan)
+        if best is None:
+            self.unavailable[name] = "; ".join(errors)
+            return
+        _, self.queries[name], self.plans[name] = best
+
+    def _scope_names(self, query):
+        return self.scope_filters.keys() if query.scoped else ()
+
+    def _render(self, query, active_filters):
+        clauses = [query.filters.get(f) or self.scope_filters[f] for f in active_filters]
+        return query.sql.format(where=" AND ".join(clauses) or "1")
+
+    def is_available(self, name):
+        return name in self.queries
+
+    def unavailable_reason(self, name):
+        """Motivo per cui la query non è disponibile con questo database."""
+        if name in self.unavailable:
+            return f"Analisi non supportata da questo database ({self.schema_version}): {self.unavailable[name]}"
+        return f"Analisi non prevista per lo schema {self.schema_version} del database."
+
+    def build(self, name, **params):
+        """Restituisce (sql, parametri) per la query richiesta, o None se non supportata dallo schema."""
+        query = self.queries.get(name)
+        if query is None:
+            return None
+        active = [f for f in list(query.filters) + list(self._scope_names(query)) if params.get(f) is not None]
+        return self._render(query, active), params
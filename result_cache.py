@@ -0,0 +1,216 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Budget complessivo della cache su disco (tutti i database): oltre, si eliminano i file usati meno di recente.
+DEFAULT_DISK_BUDGET = 1024 * 1024 * 1024
+# La cache su disco sta nella home dell'utente: i pickle non vanno letti da directory condivise.
+DISK_CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".whatsapp_forensic", "cache")
+
+
+class ResultCache:
+    """Cache LRU dei risultati delle query con budget di memoria e livello opzionale su disco.
+
+    Il database è una prova in sola lettura: a parità di impronta del database, metodo e
+    parametri il risultato non cambia, quindi può essere riutilizzato anche tra sessioni.
+    """
+    def __init__(self, namespace, max_bytes=DEFAULT_MEMORY_BUDGET, disk_dir=None, disk_max_bytes=DEFAULT_DISK_BUDGET):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.disk_root = disk_dir
+        self.disk_dir = os.path.join(disk_dir, namespace[:32]) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.current_bytes = 0
+        self.disk_bytes = 0
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+        self._entries = OrderedDict()
+        # File della cache su disco (di tutti i database) dal meno al più recente: percorso -> dimensione.
+        self._disk_entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            os.makedirs(self.disk_root, mode=0o700, exist_ok=True)
+            os.makedirs(self.disk_dir, mode=0o700, exist_ok=True)
+            self._scan_disk()
+
+    def make_key(self, *parts):
+        return hashlib.sha256(repr((self.namespace,) + parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Restituisce (trovato, valore) cercando prima in memoria e poi su disco."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+        payload = self._read_disk(key)
+        if payload is not None:
+            try:
+                value = pickle.loads(payload)
+            except Exception:
+                value = None
+            else:
+                self._store(key, value, len(payload))
+                with self._lock:
+                    self.hits += 1; self.disk_hits += 1
+                return True, value
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        if not self.disk_dir:
+            # Senza livello su disco la dimensione viene stimata: serializzare raddoppierebbe il picco di memoria.
+            self._store(key, value, _estimate_size(value))
+            return
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._store(key, value, len(payload))
+        self._write_disk(key, payload)
+
+    def _store(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _scan_disk(self):
+        files = []
+        for dirpath, _, names in os.walk(self.disk_root):
+            for name in names:
+                if name.endswith(".pkl"):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, path, st.st_size))
+        with self._lock:
+            for _, path, size in sorted(files):
+                self._disk_entries[path] = size
+            self.disk_bytes = sum(size for _, _, size in files)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                payload = f.read()
+            # La data di modifica fa da ordine LRU anche tra una sessione e l'altra.
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            if path in self._disk_entries:
+                self._disk_entries.move_to_end(path)
+        return payload
+
+    def _write_disk(self, key, payload):
+        if not self.disk_dir or len(payload) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            self.disk_bytes += len(payload) - self._disk_entries.pop(path, 0)
+            self._disk_entries[path] = len(payload)
+            pruned = []
+            while self.disk_bytes > self.disk_max_bytes and self._disk_entries:
+                old_path, size = self._disk_entries.popitem(last=False)
+                self.disk_bytes -= size
+                pruned.append(old_path)
+        for old_path in pruned:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+        if disk and self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".pkl"):
+                    path = os.path.join(self.disk_dir, name)
+                    os.remove(path)
+                    with self._lock:
+                        self.disk_bytes -= self._disk_entries.pop(path, 0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                "evictions": self.evictions, "entries": len(self._entries),
+                "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_bytes if self.disk_dir else 0,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def stats_text(self):
+        s = self.stats()
+        return (f"Cache: {s['hits']} hit ({s['disk_hits']} da disco) / {s['misses']} miss | "
+                f"{s['entries']} voci, {s['bytes'] / 1048576:.1f}/{s['max_bytes'] / 1048576:.0f} MB")
+
+
+def _estimate_size(value):
+    """Stima in byte di un risultato (righe di tuple di scalari e stringhe) senza serializzarlo."""
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_size(k) + _estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def cached_query(method):
+    """Memorizza il risultato di un metodo di DatabaseManager nella sua ResultCache.
+
+    I risultati marcati come incompleti (attributo complete=False) non vengono memorizzati;
+    i limiti della query corrente vengono applicati anche ai risultati già in cache.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = getattr(self, "cache", None)
+        if cache is None:
+            return method(self, *args, **kwargs)
+        # Normalizza gli argomenti: get_active_chats() e get_active_chats(limit=10) condividono la voce.
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        call_args = tuple(bound.arguments.items())[1:]
+        key = cache.make_key(method.__name__, call_args, self._cache_key_parts())
+        found, value = cache.get(key)
+        if not found:
+            value = method(self, *args, **kwargs)
+            if getattr(value, "complete", True):
+                cache.put(key, value)
+        # I budget di righe/byte del contesto valgono anche per i risultati presi dalla cache.
+        apply_limits = getattr(self, "_apply_query_limits", None)
+        return apply_limits(value) if apply_limits else value
+    return wrapper